@@ -1,15 +1,22 @@
 from __future__ import print_function
 from exif2timestream import cli_options, setup_logs, SkipImage, path_exists, bool_str, date_end, date, \
-    int_time_hr_min, get_file_date, d2s, image_type_str, _dont_clobber, find_empty_dirs
+    int_time_hr_min, get_file_date, d2s, image_type_str, _dont_clobber, find_empty_dirs, \
+    move_file, ensure_dir, get_time_from_filename, _scandir_walk, scandir
+import calendar
 import sys
 import time
 import csv
 import logging
 import os
 import multiprocessing
-import shutil
+from multiprocessing.pool import ThreadPool
 import struct
 log = logging.getLogger("exif2timestream")
+# Camera-wide arguments to process_image, set by _init_worker
+_worker_state = {}
+# Minutes from the edge of the date or time window inside which a date read
+# from the file name is double-checked against the image's EXIF
+FILENAME_DATE_MARGIN = 60
 class CameraFields(object):
     """Validate input and translate between exif and config.csv fields."""
     # Validation functions, then schema, then the __init__ and execution
@@ -32,154 +39,221 @@ class CameraFields(object):
     REQUIRED = {"use", "timestream_name", "root_path", "delete_dest", "expt_end", "expt_start", "start_time",
                 "end_time", 'image_types'}
     SCHEMA = dict((a, c) for a, b, c in ts_csv_fields)
+    # One slot per config field, so cameras are small and cheap to pickle
+    __slots__ = tuple(a for a, b, c in ts_csv_fields)
 
     def __init__(self, csv_config_dict):
         """Store csv settings as object attributes and validate."""
-        csv_config_dict = {self.CSV_TS[k]: v for k, v in
-                           csv_config_dict.items() if k in self.CSV_TS}
-        if not all(key in csv_config_dict for key in self.REQUIRED):
+        # Translate, validate and set each known field in a single pass
+        fields = set()
+        for csv_key, value in csv_config_dict.items():
+            key = self.CSV_TS.get(csv_key)
+            if key is not None:
+                setattr(self, key, self.SCHEMA[key](value))
+                fields.add(key)
+        if not self.REQUIRED <= fields:
             raise ValueError('CSV config dict lacks required key/s.' + str(csv_config_dict))
 
-        # Converts dict keys and calls validation function on each value
-        csv_config_dict = {k: self.SCHEMA[k](v)
-                           for k, v in csv_config_dict.items()}
-        # Set object attributes from config
-        for k, v in csv_config_dict.items():
-            setattr(self, self.CSV_TS[k] if k in self.CSV_TS else k, v)
-
         # Localise pathnames
         def local(p):
             """Ensure that pathnames are correct for this system."""
             return p.replace(r'\\', '/').replace('/', os.path.sep)
         self.root_path = local(self.root_path)
-        log.debug("Validated camera '{}'".format(csv_config_dict))
+        log.debug("Validated camera '%s'", csv_config_dict)
 
 def parse_camera_config_csv(filename):
     """Parse a camera configuration, yielding localised and validated
     camera configuration objects."""
     if filename is None:
-        raise StopIteration
+        return []
     with open(filename) as fh:
 
-        cam_config = csv.DictReader(fh)
+        cam_config = csv.reader(fh)
+        header = next(cam_config)
         cameras = []
-        for camera in cam_config:
+        for row in cam_config:
             try:
-                camera = CameraFields(camera)
+                camera = CameraFields(dict(zip(header, row)))
                 if camera.use:
                     cameras.append(camera)
             except (SkipImage, ValueError) as e:
                 continue
         return cameras
 
+def _walk_image_files(walk):
+    """Walk one source tree once, bucketing its files by extension."""
+    src, exts = walk
+    log.info("Walking from %s to find %s images", src, exts)
+    ext_files = dict((ext, []) for ext in exts)
+    # "raw" has always collected every file in its tree
+    all_files = ext_files.get("raw")
+    for entry in _scandir_walk(src):
+        this_ext = entry.name.rpartition('.')[2].lower()
+        if this_ext != "raw" and this_ext in ext_files:
+            ext_files[this_ext].append(entry.path)
+        if all_files is not None:
+            all_files.append(entry.path)
+    return ext_files
+
 def find_image_files(camera):
     """Scrape a directory for image files, by extension.
     Possibly, in future, use file magic numbers, but a bad idea on windows.
     """
     exts = camera.image_types
-    ext_files = {}
+    # Each extension is walked from its own subdir if there is one, else root
+    ext_roots = dict((ext, camera.root_path) for ext in exts)
+    for entry in scandir(camera.root_path):
+        name = entry.name.lower()
+        if name in ext_roots and entry.name[0] not in ('.', '_') and entry.is_dir():
+            log.debug("Found src subdir %s", entry.name)
+            ext_roots[name] = entry.path
+    walks = {}
     for ext in exts:
-        src = camera.root_path
-
-        lst = [x for x in os.listdir(src) if not x[0] in ('.', '_')]
-        log.debug("List of src valid subdirs is {}".format(lst))
-        for node in lst:
-            log.debug("Found src subdir {}".format(node))
-            if node.lower() == ext:
-                src = os.path.join(src, node)
-                break
-        log.info("Walking from {} to find images".format(src))
-        for cur_dir, dirs, files in os.walk(src):
-            # for d in dirs:
-            #     if not (d.lower() in IMAGE_SUBFOLDERS or d.startswith("_")):
-            #         if not camera.method in ("resize", "json"):
-            #             #log.error("Source directory has too many subdirs.")
-
-            for fle in files:
-                this_ext = os.path.splitext(fle)[-1].lower().strip(".")
-                if ext in (this_ext, "raw"):
-                    fle_path = os.path.join(cur_dir, fle)
-                    try:
-                        ext_files[ext].append(fle_path)
-                    except KeyError:
-                        ext_files[ext] = []
-                        ext_files[ext].append(fle_path)
-            log.info("Found {0} {1} files for camera.".format(
-                len(ext_files), ext))
+        walks.setdefault(ext_roots[ext], []).append(ext)
+    if len(walks) == 1:
+        found = [_walk_image_files(walk) for walk in walks.items()]
+    else:
+        # Directory reads release the GIL, so separate trees walk concurrently
+        pool = ThreadPool(len(walks))
+        found = pool.map(_walk_image_files, walks.items())
+        pool.close()
+        pool.join()
+    ext_files = {}
+    for walk_files in found:
+        for ext, files in walk_files.items():
+            if files:
+                ext_files[ext] = files
+            log.info("Found %s %s files for camera.", len(files), ext)
     return ext_files
 
-def process_image(args):
-    log.debug("Starting to process image")
-    image, camera, ext = args
+def _init_worker(camera, ext):
+    """Stash the camera-wide arguments once per process for process_image."""
+    _worker_state["camera"] = camera
+    _worker_state["ext"] = ext
+    # The date and time window as plain ints, so each image compares cheaply
+    _worker_state["start_epoch"] = calendar.timegm(camera.expt_start)
+    _worker_state["end_epoch"] = calendar.timegm(camera.expt_end)
+    _worker_state["start_minute"] = camera.start_time[0] * 60 + camera.start_time[1]
+    _worker_state["end_minute"] = camera.end_time[0] * 60 + camera.end_time[1]
+    # Images are archived under delete_dest/<root dir name>/<path below root>
+    _worker_state["archive_root"] = os.path.join(
+        camera.delete_dest, os.path.basename(os.path.normpath(camera.root_path)))
+    _worker_state["root_prefix_len"] = len(os.path.join(camera.root_path, ''))
+
+def _worker_pool(threads, camera, ext):
+    """Start a pool whose workers all have the camera-wide arguments set."""
+    _init_worker(camera, ext)
+    # Forked workers inherit _worker_state, so nothing is pickled to them
+    if hasattr(multiprocessing, "get_context"):
+        if "fork" in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context("fork").Pool(threads)
+    elif os.name == "posix":
+        # Python 2 always forks here
+        return multiprocessing.Pool(threads)
+    return multiprocessing.Pool(threads, initializer=_init_worker,
+                                initargs=(camera, ext))
+
+def _filename_date(image):
+    """Date an image from its file name alone, when that can't be borderline.
+
+    Returns None if the name holds no date, or if the date falls within
+    FILENAME_DATE_MARGIN minutes of the date or time window, so that the
+    caller reads the authoritative EXIF date instead.
+    """
+    date_mask = _worker_state["camera"].date_mask
+    if not date_mask:
+        return None
+    image_date = get_time_from_filename(os.path.basename(image), date_mask)
+    if image_date is None:
+        return None
+    margin = FILENAME_DATE_MARGIN * 60
+    epoch = calendar.timegm(image_date)
+    for bound in (_worker_state["start_epoch"], _worker_state["end_epoch"]):
+        if abs(epoch - bound) < margin:
+            return None
+    minute = image_date.tm_hour * 60 + image_date.tm_min
+    for bound in (_worker_state["start_minute"], _worker_state["end_minute"]):
+        diff = abs(minute - bound)
+        if min(diff, 24 * 60 - diff) < FILENAME_DATE_MARGIN:
+            return None
+    return image_date
+
+def process_image(image):
+    camera = _worker_state["camera"]
     delete = False
     if "last_image" in image.lower() :
-        log.debug ("Skipping file {}, assumed last image".format(image))
+        log.debug("Skipping file %s, assumed last image", image)
         return
     try:
-        image_date = get_file_date(image, 0, round_secs=1,date_mask=camera.date_mask)
-        time_tuple = (image_date.tm_hour, image_date.tm_min)
+        image_date = _filename_date(image)
+        if image_date is None:
+            image_date = get_file_date(image, 0, round_secs=1,date_mask=camera.date_mask)
+        minute = image_date.tm_hour * 60 + image_date.tm_min
+        epoch = calendar.timegm(image_date)
         if image_date is None:
             pass
-        elif camera.expt_start > image_date or image_date > camera.expt_end:
-            log.debug("Deleting {}. Outside of date range {} to {}".format(
-                image, d2s(camera.expt_start), d2s(camera.expt_end)))
+        elif _worker_state["start_epoch"] > epoch or epoch > _worker_state["end_epoch"]:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Deleting %s. Outside of date range %s to %s",
+                          image, d2s(camera.expt_start), d2s(camera.expt_end))
             delete=True;
             # print("Deleting {}. Outside of date range {} to {}".format(
             #     image, d2s(camera.expt_start), d2s(camera.expt_end)))
-        elif(camera.start_time > time_tuple or time_tuple > camera.end_time):
-            log.debug("Deleting {}. Outside of Time range {} to {}".format(
-                image, camera.start_time, camera.end_time))
+        elif(_worker_state["start_minute"] > minute or minute > _worker_state["end_minute"]):
+            log.debug("Deleting %s. Outside of Time range %s to %s",
+                      image, camera.start_time, camera.end_time)
             delete=True;
             # print("Deleting {}. Outside of Time range {} to {}".format(
             #     image, camera.start_time, camera.end_time))
         else:
-            log.debug("Not touching image {} as it doesnt fall otuside time or date range".format(image))
+            log.debug("Not touching image %s as it doesnt fall otuside time or date range", image)
         if(delete):
             try:
-                log.debug("Will move {}".format(image))
+                log.debug("Will move %s", image)
+                # image always starts with root_path, as that's where we walked
                 archive_image = os.path.join(
-                    camera.delete_dest,
-                    os.path.basename(os.path.normpath(camera.root_path)),
-                    os.path.relpath(image, camera.root_path))
-                try:
-                    os.makedirs(os.path.dirname(archive_image))
-                    log.debug("Made archive dir {}".format(os.path.dirname(
-                        archive_image)))
-                except OSError as exc:
-                    if not os.path.exists(os.path.dirname(archive_image)):
-                        raise exc
+                    _worker_state["archive_root"],
+                    image[_worker_state["root_prefix_len"]:])
+                ensure_dir(os.path.dirname(archive_image))
                 archive_image = _dont_clobber(archive_image)
-                shutil.copyfile(image, archive_image)
-                log.debug("Copied {} to {}".format(image, archive_image))
-                os.unlink(image)
-            except OSError:
-                log.error("Could not delete '{0}'".format(image))
-                log.debug("Deleted {}".format(image))
+                move_file(image, archive_image)
+                log.debug("Moved %s to %s", image, archive_image)
+            except (IOError, OSError):
+                log.error("Could not delete '%s'", image)
+                log.debug("Deleted %s", image)
     except (AttributeError, struct.error):
-        log.error ("Failed on this image", image)
+        log.error("Failed on this image %s", image)
 
 
     # if camera.start_time > image_date
 
 
 def process_timestream(camera, ext, images, n_threads=1):
+    if os.path.normpath(camera.delete_dest) == os.path.normpath(camera.root_path):
+        log.warning("Not archiving %s images into their own root path %s",
+                    camera.timestream_name, camera.root_path)
+        return
     if n_threads == 1:
         log.info("Using 1 process - what is this? 1990?")
+        _init_worker(camera, ext)
         for count, image in enumerate(images):
-            print("Processed {:5d} Images".format(count), end='\r')
-            process_image((image, camera, ext))
+            if count % 256 == 0:
+                print("Processed {:5d} Images".format(count), end='\r')
+            process_image(image)
     else:
         threads = max(1, min(n_threads, multiprocessing.cpu_count() - 1))
-        log.info("Using {0:d} processes".format(threads))
-        # set the function's camera-wide arguments
-        args = ((image, camera, ext) for image in images)
-        pool = multiprocessing.Pool(threads)
-        for count, _ in enumerate(pool.imap(process_image, args)):
-            print("Processed {:5d} Images".format(count), end='\r')
+        log.info("Using %d processes", threads)
+        # each task only pickles an image path, and they go out in batches
+        pool = _worker_pool(threads, camera, ext)
+        chunksize = max(16, len(images) // (threads * 8))
+        for count, _ in enumerate(pool.imap_unordered(process_image, images,
+                                                      chunksize=chunksize)):
+            if count % 256 == 0:
+                print("Processed {:5d} Images".format(count), end='\r')
         pool.close()
         pool.join()
     find_empty_dirs(camera.root_path)
-    print("Processed {:5d} Images. Finished this cam!".format(count))
+    print("Processed {:5d} Images. Finished this cam!".format(len(images)))
 
 
 def main(configfile, n_threads=1, logdir=None, debug=False):
@@ -190,18 +264,16 @@ def main(configfile, n_threads=1, logdir=None, debug=False):
         print("Processing Timestream {}".format(
             camera.timestream_name))
         print ("Archiving images between Times {}, {} and Dates {}, {}".format(camera.start_time, camera.end_time, time.strftime("%Y/%m/%d", camera.expt_start), time.strftime("%Y/%m/%d", camera.expt_end)))
-        log.info("Processing Timestream {}".format(
-            camera.timestream_name))
-        log.info("Archiving images between Times {}, {} and Dates {}, {}".format(camera.start_time, camera.end_time, time.strftime("%Y/%m/%d", camera.expt_start), time.strftime("%Y/%m/%d", camera.expt_end)))
+        log.info("Processing Timestream %s", camera.timestream_name)
+        log.info("Archiving images between Times %s, %s and Dates %s, %s", camera.start_time, camera.end_time, time.strftime("%Y/%m/%d", camera.expt_start), time.strftime("%Y/%m/%d", camera.expt_end))
 
 
         for ext, images in find_image_files(camera).items():
             print(("Have {0} {1} images from this camera".format(
                 len(images), ext)))
-            log.info("Have {0} {1} images from this camera".format(
-                len(images), ext))
+            log.info("Have %s %s images from this camera", len(images), ext)
             n_images += len(images)
-            process_timestream(camera, ext, sorted(images), n_threads)
+            process_timestream(camera, ext, images, n_threads)
 
 def gen_config(fname):
     """Write example config and exit if a filename is passed."""
@@ -1,16 +1,42 @@
 """ Crawl through a root directory and audit all of the timestreams inside"""
-from operator import itemgetter
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import csv
+import matplotlib
+# Graphs are only ever saved to files, so never start a GUI backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import argparse
 from datetime import datetime, timedelta, date
-from os import walk, path  # , listdir
+from functools import partial
+from os import stat, path, makedirs, environ  # , listdir
+try:
+    from os import scandir, replace
+except ImportError:
+    # Python 2 has scandir from its package, and rename replaces on POSIX
+    from scandir import scandir
+    from os import rename as replace
+import hashlib
+import json
 import re
-from collections import Counter, OrderedDict
+from collections import OrderedDict, defaultdict
 import numpy as np
 from exif2timestream import get_time_from_filename
 
+# Timestream directory names, and the date stamped into image file names
+TS_RE = re.compile(r"~fullres-(orig|raw)")
+IMG_RE = re.compile(r"(\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2})")
+# Offsets in a YYYY_MM_DD_HH_MM_SS stamp of the separators ISO 8601 differs on
+ISO_SEPARATORS = ((4, '-'), (7, '-'), (10, 'T'), (13, ':'), (16, ':'))
+# Most subdirectories that find_timestreams or find_images read at once
+SCAN_THREADS = 8
+# Where each timestream's image date stamps and subdirectories are kept, by
+# directory, to reuse while the directory's mtime is unchanged
+CACHE_DIR = path.join(environ.get("XDG_CACHE_HOME") or path.expanduser(path.join("~", ".cache")),
+                      "timestream_audit")
+# Intervals a camera can be set to take images at, in ascending seconds
+POSSIBLE_INTERVALS = np.array([60 * x for x in (1, 5, 10, 15, 30, 60)])
+
 
 def cli_options():
     """Return CLI arguments with argparse."""
@@ -21,16 +47,49 @@ def cli_options():
                         help='Output Directory')
     parser.add_argument('-t', '--threads', type=int, default=1,
                         help='Number of Threads')
+    parser.add_argument('-c', '--cache', default=CACHE_DIR,
+                        help='Directory to keep listings in between audits, '
+                             'or "" not to keep them')
     return parser.parse_args()
 
 
+def _split_entries(entries):
+    """Split directory entries into timestreams and other subdirectories to search."""
+    timestreams, subdirs = [], []
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        if TS_RE.search(entry.name):
+            # Only images live inside a timestream, so it isn't searched further
+            timestreams.append(entry.path)
+        elif not entry.is_symlink():
+            subdirs.append(entry.path)
+    return timestreams, subdirs
+
+
+def _find_timestreams(directory):
+    """Return the paths of every timestream directory below directory."""
+    try:
+        timestreams, subdirs = _split_entries(scandir(directory))
+    except OSError:
+        return []
+    for subdir in subdirs:
+        timestreams.extend(_find_timestreams(subdir))
+    return timestreams
+
+
 def find_timestreams(input_directory):
-    timestreams = []
-    for root, dirs, files in walk(input_directory):
-        for directory in dirs:
-            prog = re.compile("~fullres-(orig|raw)")
-            if (prog.search(directory)):
-                timestreams.append(root + path.sep + directory)
+    try:
+        timestreams, subdirs = _split_entries(scandir(input_directory))
+    except OSError:
+        return []
+    if subdirs:
+        # Directory reads release the GIL, so subdirectories scan concurrently
+        pool = ThreadPool(min(len(subdirs), SCAN_THREADS))
+        for sub_timestreams in pool.imap(_find_timestreams, subdirs):
+            timestreams.extend(sub_timestreams)
+        pool.close()
+        pool.join()
     return timestreams
     # prog = re.compile("~fullres-(orig|raw)")
     # if prog.search(input_directory):
@@ -43,94 +102,194 @@ def find_timestreams(input_directory):
     #     return sub_streams
 
 
-def find_images(timestream_directory):
-    """ Given a timestream directory, return a bunch of datetime objects which store imagea dates"""
-    images = []
-    for root, dirs, files in walk(timestream_directory):
-        regex = re.compile("(\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2})")
-        for file in files:
-            matches = regex.findall(file)
-            if (matches):
-                images.append(datetime.strptime((matches)[0], "%Y_%m_%d_%H_%M_%S"))
-    return images
+def _parse_stamps(stamps):
+    """Parse a list of YYYY_MM_DD_HH_MM_SS stamps to a sorted datetime64 array."""
+    if not stamps:
+        return np.array([], dtype='datetime64[s]')
+    # Rewrite the separators in place, then numpy parses (and checks) them all
+    chars = np.array(stamps, dtype='S19').view(np.uint8).reshape(-1, 19)
+    for offset, separator in ISO_SEPARATORS:
+        chars[:, offset] = ord(separator)
+    return np.sort(chars.view('S19').ravel().astype('datetime64[s]'))
+
+
+def _match_stamps(entries):
+    """Return the date stamps in the names of the files among entries."""
+    stamps = []
+    for entry in entries:
+        if not entry.is_dir():
+            match = IMG_RE.search(entry.name)
+            if (match):
+                stamps.append(match.group(1))
+    return stamps
+
+
+def _list_stamps(directory, cache, new_cache):
+    """Return the date stamps and subdirectories directly in directory.
+
+    The listing comes from cache if directory's mtime is the one it was
+    listed at, and is recorded in new_cache either way.
+    """
+    try:
+        mtime = stat(directory).st_mtime
+    except OSError:
+        return [], []
+    listing = cache.get(directory)
+    if not listing or listing[0] != mtime:
+        try:
+            entries = list(scandir(directory))
+        except OSError:
+            return [], []
+        listing = (mtime, _match_stamps(entries),
+                   [entry.path for entry in entries
+                    if entry.is_dir() and not entry.is_symlink()])
+    new_cache[directory] = listing
+    return listing[1], listing[2]
+
+
+def _find_stamps(directory, cache, new_cache):
+    """Return the date stamps of every image file below directory."""
+    stamps, subdirs = _list_stamps(directory, cache, new_cache)
+    stamps = list(stamps)
+    for subdir in subdirs:
+        stamps.extend(_find_stamps(subdir, cache, new_cache))
+    return stamps
+
+
+def _image_cache_file(cache_dir, timestream_directory):
+    """Return the file in cache_dir that a timestream's listings are kept in."""
+    name = hashlib.sha1(path.abspath(timestream_directory).encode('utf-8')).hexdigest()
+    return path.join(cache_dir, name + '.json')
+
+
+def _load_image_cache(cache_file):
+    """Return the directory listings saved by the last audit, if any."""
+    try:
+        with open(cache_file) as fh:
+            cache = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save_image_cache(cache_file, cache):
+    """Save the directory listings for the next audit, if we can."""
+    try:
+        with open(cache_file + '.tmp', 'w') as fh:
+            json.dump(cache, fh, separators=(',', ':'))
+        replace(cache_file + '.tmp', cache_file)
+    except (IOError, OSError):
+        # The timestream is just listed afresh next time
+        pass
+
+
+def find_images(timestream_directory, cache_dir=None):
+    """ Given a timestream directory, return a sorted datetime64 array of its image dates
+
+    Directory listings are kept in cache_dir between audits, if it's given.
+    """
+    cache_file = cache_dir and _image_cache_file(cache_dir, timestream_directory)
+    cache = _load_image_cache(cache_file) if cache_file else {}
+    new_cache = {}
+    stamps, subdirs = _list_stamps(timestream_directory, cache, new_cache)
+    stamps = list(stamps)
+    if subdirs:
+        # Directory reads release the GIL, so subdirectories scan concurrently
+        pool = ThreadPool(min(len(subdirs), SCAN_THREADS))
+        for sub_stamps in pool.imap_unordered(
+                partial(_find_stamps, cache=cache, new_cache=new_cache), subdirs):
+            stamps.extend(sub_stamps)
+        pool.close()
+        pool.join()
+    if cache_file:
+        _save_image_cache(cache_file, new_cache)
+    return _parse_stamps(stamps)
 
 
 def get_interval(date_times):
-    """ Given a list of sorted datetimes, calculate the interval between images """
-    dates = {}
-    possible_intervals = []
-    for x in [60, 30, 15, 10, 5, 1]:
-        possible_intervals.append(timedelta(minutes=x))
-    for d in date_times:
-        date = d.date()
-        try:
-            dates[str(d.year) + "-" + str(d.month) + "-" + str(d.day)].append(d)
-        except:
-            dates[str(d.year) + "-" + str(d.month) + "-" + str(d.day)] = [(d)]
-    differences = []
-    for date, times in dates.iteritems():
-        if len(times) > 1:
-            diff = ([j - i for i, j in zip(times[:-1], times[1:])])
-            int = timedelta(minutes=60)
-            sort_diff = (sorted(Counter(diff).most_common(), key=itemgetter(1), reverse=True))
-            for pos_int in sort_diff:
-                if pos_int[0] in possible_intervals:
-                    int = pos_int[0]
-                    break
-            differences.append(int)
-    interval = (sum(differences, timedelta(0)) / len(differences))
-    if ((interval.seconds / 60) > 30):
-        interval = (((interval.seconds / 60) + 1) * 60)
+    """ Given sorted image datetimes, calculate the interval between images """
+    allowed = POSSIBLE_INTERVALS
+    times = np.asarray(date_times, dtype='datetime64[s]')
+    days = times.astype('datetime64[D]')
+    # The gaps between consecutive images taken on the same day, and which
+    # image and day each one follows
+    same_day = days[1:] == days[:-1]
+    gaps = np.diff(times).astype(np.int64)[same_day]
+    gap_pos = np.flatnonzero(same_day)
+    day_ids, gap_day = np.unique(days[1:][same_day], return_inverse=True)
+    # Tally each day's gaps that are possible intervals, and where each is first seen
+    slot = np.searchsorted(allowed, gaps).clip(max=len(allowed) - 1)
+    valid = allowed[slot] == gaps
+    counts = np.bincount(gap_day[valid] * len(allowed) + slot[valid],
+                         minlength=len(day_ids) * len(allowed)).reshape(len(day_ids), len(allowed))
+    first = np.full(counts.shape, len(times), dtype=np.int64)
+    np.minimum.at(first, (gap_day[valid], slot[valid]), gap_pos[valid])
+    # A day's interval is its most common possible gap, ties going to the one
+    # seen first, or an hour if it has none
+    score = np.where(counts > 0, counts * (len(times) + 1) - first, -1)
+    modal = np.where(counts.any(axis=1), allowed[score.argmax(axis=1)], 3600)
+    # The mean of the days' intervals, floored to whole minutes
+    minutes = int(modal.sum()) // (60 * len(modal))
+    if (minutes > 30):
+        interval = ((minutes + 1) * 60)
     else:
-        interval = ((interval.seconds / 60) * 60)
+        interval = (minutes * 60)
     return interval
 
 
 def get_start_end(date_times):
-    """ Given a sorted list of datetimes, calculate the start and end times of images"""
-    times = sorted(date.time() for date in date_times)
-    min, max = times[0], times[-1]
-    return min, max
+    """ Given sorted image datetimes, calculate the start and end times of images"""
+    # Sorted by datetime, not time of day, so the ends aren't the extremes
+    seconds = np.asarray(date_times, dtype='datetime64[s]').astype(np.int64) % 86400
+    return tuple((datetime.min + timedelta(seconds=int(s))).time()
+                 for s in (seconds.min(), seconds.max()))
+
+
+def _since_midnight(t):
+    """Return the time of day t as a timedelta, without building a datetime."""
+    return timedelta(hours=t.hour, minutes=t.minute, seconds=t.second,
+                     microseconds=t.microsecond)
 
 
 def find_missing_images(date_times, start_date, end_date, start_time, end_time, interval):
-    today = start_date
-    first = True
-    missing = {}
-    while (today <= end_date):
-        if len(date_times):
-            time = start_time
-            while (time <= end_time):
-                if len(date_times):
-                    now = datetime(today.year, today.month, today.day, time.hour, time.minute, time.second)
-                    if now in date_times:
-                        date_times.remove(now)
-                        first = False
-                    elif not first:
-                        try:
-                            missing[today].append(now)
-                        except:
-                            missing[today] = [now]
-                new_date = now + timedelta(seconds=interval)
-                if now.date() < (new_date).date():
-                    break
-                now = new_date
-                time = now.time()
-        today += timedelta(days=1)
-    return missing
+    """Return a sorted datetime64 array of the expected image times with no image."""
+    none_missing = np.array([], dtype='datetime64[us]')
+    # Every expected image time, broadcast as a row of times through the day
+    # for each day
+    days = np.arange(start_date, end_date + timedelta(days=1), dtype='datetime64[D]')
+    times_of_day = np.arange(np.timedelta64(_since_midnight(start_time)),
+                             np.timedelta64(_since_midnight(end_time)) + np.timedelta64(1, 'us'),
+                             np.timedelta64(timedelta(seconds=interval)))
+    expected = (days[:, None] + times_of_day).ravel()
+    if not len(expected):
+        return none_missing
+    actual = np.asarray(date_times, dtype='datetime64[us]')
+    # The expected times are sorted, so each image's is found by binary
+    # search, and marked as found if the image falls exactly on it
+    pos = np.searchsorted(expected, actual).clip(max=len(expected) - 1)
+    on_grid = expected[pos] == actual
+    found = np.zeros(len(expected), dtype=bool)
+    found[pos[on_grid]] = True
+    found_at = np.flatnonzero(found)
+    if not len(found_at):
+        return none_missing
+    # Times are only missing after the first image, and, if every image fell
+    # on an expected time, up to the last
+    first = found_at[0]
+    last = found_at[-1] if on_grid.all() else len(expected) - 1
+    gaps = first + np.flatnonzero(~found[first:last + 1])
+    return expected[gaps]
 
 
 def plot_missing_images_graph(missing_images, timestream, start_date, end_date, ipd):
-    pltx = []
-    plty = []
-    today = start_date
-    while today <= end_date:
-        pltx.append(today)
-        if today in missing_images.keys():
-            plty.append(1 - ((len(missing_images[today]) / ipd)))
-        else:
-            plty.append(1)
-        today += timedelta(days=1)
+    # Arrays, so they pickle back from the pool workers as flat buffers
+    pltx = np.arange(start_date, end_date + timedelta(days=1), dtype='datetime64[D]')
+    plty = np.ones(len(pltx))
+    # Missing images per day, counted straight off the missing times
+    per_day = np.bincount((missing_images.astype('datetime64[D]') - pltx[0]).astype(np.int64),
+                          minlength=len(pltx))
+    some_missing = per_day > 0
+    plty[some_missing] = 1 - (per_day[some_missing] / ipd)
     # N = len(pltx)
     # ind = np.arange(N)  # the x locations for the groups
     # width = 0.35  # the width of the bars
@@ -163,84 +322,73 @@ def plot_missing_images_graph(missing_images, timestream, start_date, end_date,
 
 
 def output_missing_images_csv(missing_images, timestream, iph):
-    with open(timestream + path.sep + timestream.split(path.sep)[-1] + "_missing_images.csv", 'w+') as csvfile:
-        field_names = ["date", "time", timestream.split(path.sep)[-1]]
-        writer = csv.DictWriter(csvfile, fieldnames=field_names, lineterminator='\n')
-        writer.writeheader()
-        output = []
-        for date, images in missing_images.iteritems():
-            hour = {}
-            for image in images:
-                try:
-                    hour[image.time().strftime("%H")] += 1
-                except KeyError:
-                    hour[image.time().strftime("%H")] = 1
-            for h, number in hour.iteritems():
-                output.append([date.strftime("%Y-%m-%d"), h + ":00", (number / iph)])
-        for line in sorted(output):
-            writer.writerow({"date": line[0], "time": line[1], timestream.split(path.sep)[-1]: line[2]})
-            # writer.writerow({"date":date.strftime("%Y_%m_%d"),"time":h + "_00_00", timestream.split(path.sep)[-1]:(number/ipd)*100})
+    name = path.basename(timestream)
+    with open(timestream + path.sep + name + "_missing_images.csv", 'w',
+              1 << 20) as csvfile:
+        field_names = ["date", "time", name]
+        writer = csv.writer(csvfile, lineterminator='\n')
+        writer.writerow(field_names)
+        # Missing images counted by hour, in order; only each row's labels are formatted
+        hours, number = np.unique(missing_images.astype('datetime64[h]'), return_counts=True)
+        days = hours.astype('datetime64[D]')
+        hour_labels = ["{:02d}:00".format(h) for h in (hours - days).astype(np.int64).tolist()]
+        writer.writerows(zip(days.astype(str).tolist(), hour_labels, (number / iph).tolist()))
+        # writer.writerow({"date":date.strftime("%Y_%m_%d"),"time":h + "_00_00", timestream.split(path.sep)[-1]:(number/ipd)*100})
 
 
 def images_per_day(start_time, end_time, interval):
-    images = (datetime.combine(date.today(), end_time) - datetime.combine(date.today(),
-                                                                          start_time)).total_seconds() / interval
+    images = (_since_midnight(end_time) - _since_midnight(start_time)).total_seconds() / interval
     return images
 
 
 def output_all_missing_images(ts_missing, output_directory, start_date, end_date, filename=''):
-    with open(output_directory + path.sep + filename + "total_missing_images.csv", 'w+') as csvfile:
+    with open(output_directory + path.sep + filename + "total_missing_images.csv", 'w',
+              1 << 20) as csvfile:
         field_names = ["date"]
-        for timestream, other in ts_missing.iteritems():
-            field_names.append(timestream.split(path.sep)[-1])
-        d = {}
+        for timestream in ts_missing:
+            field_names.append(path.basename(timestream))
+        d = defaultdict(dict)
         old_expt = 0
         count = 0
-        for timestream, (dates, per_missing) in ts_missing.iteritems():
-            experiment_number = re.sub("\D", "", timestream.split(path.sep)[-1].split('-')[0])
+        for timestream, (dates, per_missing) in ts_missing.items():
+            experiment_number = re.sub(r"\D", "", path.basename(timestream).split('-')[0])
             experiment_number = (int(experiment_number))
             if (old_expt != experiment_number):
                 old_expt = experiment_number
                 count = 0
-            for (x, y) in zip(dates, per_missing):
-                try:
-                    a = experiment_number * 10 + y + count
-                    d[x.strftime("%Y-%m-%d")][timestream] = a
-                except:
-                    d[x.strftime("%Y-%m-%d")] = {}
-                    d[x.strftime("%Y-%m-%d")][timestream] = a
+            for (x, y) in zip(dates.tolist(), per_missing.tolist()):
+                d[x.strftime("%Y-%m-%d")][timestream] = experiment_number * 10 + y + count
             count += 1
         writer = csv.writer(csvfile, lineterminator='\n')
         output = []
         writer.writerow(field_names)
-        for date, timestreams in d.iteritems():
+        for date, timestreams in d.items():
             row = [date]
-            for timestream, other in ts_missing.iteritems():
-                if timestream in timestreams.keys():
+            for timestream in ts_missing:
+                if timestream in timestreams:
                     perc = timestreams[timestream]
                     # row.append(timestreams[timestream])
                     # appended = True
                     row.append(perc)
                 else:
-                    # experiment_number = re.sub("\D", "", timestream.split(path.sep)[-1].split('-')[0])
+                    # experiment_number = re.sub(r"\D", "", timestream.split(path.sep)[-1].split('-')[0])
                     # experiment_number = (int(experiment_number))
                     row.append("")
                 count += 1
             output.append(row)
-        output = sorted(output)
-        for line in output:
-            writer.writerow(line)
+        writer.writerows(sorted(output))
 
 
 def graph_all_missing_images(all_missing_images, output_directory, start_date, end_date):
     pltx = []  # Timestream names
     plty = []  # % of missing images
-    for timestream, (dates, per_missing) in all_missing_images.iteritems():
-        pltx.append(timestream.split(path.sep)[-1])
+    for timestream, (dates, per_missing) in all_missing_images.items():
+        pltx.append(path.basename(timestream))
         percentage_missing = ((sum(per_missing) / len(per_missing)) if len(per_missing) else 0.0)
         plty.append(percentage_missing)
 
     N = len(pltx)
+    plty = np.asarray(plty)
 
     ind = np.arange(N)  # the x locations for the groups
     width = 0.35  # the width of the bars
@@ -254,20 +402,12 @@ def graph_all_missing_images(all_missing_images, output_directory, start_date, e
     plt.ylim([0.0, 100.0])
     plt.xticks(rotation="vertical")
     ax.set_xticklabels(pltx)
-    rects = ax.patches
-
-    def autolabel(rects):
-        # attach some text labels
-        for rect in rects:
-            height = rect.get_height()
-            ax.text(rect.get_x() + rect.get_width() / 2., 1.05 * height,
-                    '{}'.format(round(height, 3)),
-                    ha='center', va='bottom')
-
-    autolabel(rects1)
+    # label every bar in one call, rather than placing each text by hand
+    ax.bar_label(rects1, labels=['{}'.format(round(height, 3)) for height in plty],
+                 padding=3)
     fig.set_size_inches((5 + 1 * len(pltx)), 5)
-    plt.savefig(output_directory + path.sep + "total_missing_images.jpg", bbox_inches='tight')
-    fig = plt.gcf()
+    fig.savefig(output_directory + path.sep + "total_missing_images.jpg", bbox_inches='tight')
+    plt.close(fig)
 
 
 def graph_all_missing_images_over_time(all_missing_images, output_directory, start_date, end_date):
@@ -277,23 +417,23 @@ def graph_all_missing_images_over_time(all_missing_images, output_directory, sta
     f.subplots_adjust(hspace=0)
     plt.setp([a.get_xticklabels() for a in f.axes[:-1]], visible=False)
     i = 0
-    for timestream, (dates, per_missing) in all_missing_images.iteritems():
+    for timestream, (dates, per_missing) in all_missing_images.items():
         plots[i].plot(dates, per_missing)
-        plots[i].set_ylabel(timestream.split(path.sep)[-1], rotation="horizontal", labelpad=130)
+        plots[i].set_ylabel(path.basename(timestream), rotation="horizontal", labelpad=130)
         i += 1
     f.set_size_inches((5 + (end_date - start_date).days / 30), (5 + 1 * len(all_missing_images)))
     plt.ylim([-10.0, 110.0])
     plt.xticks(rotation=30)
-    plt.savefig(output_directory + path.sep + "total_missing_images_over_time.jpg", bbox_inches='tight')
+    f.savefig(output_directory + path.sep + "total_missing_images_over_time.jpg", bbox_inches='tight')
+    plt.close(f)
 
 
-def timestream_function(timestream):
-    date_times = sorted(find_images(timestream))
-    if (date_times):
+def timestream_function(timestream, cache_dir=None):
+    date_times = find_images(timestream, cache_dir)
+    if len(date_times):
         print("Beginning timestream " + timestream)
         # print("Getting relevant data")
-        start_date = date_times[0].date()
-        end_date = date_times[-1].date()
+        start_date, end_date = date_times[[0, -1]].astype('datetime64[D]').tolist()
         start_time, end_time = get_start_end(date_times)
         interval = get_interval(date_times)
         # print("Calculating images per day")
@@ -314,39 +454,32 @@ def timestream_function(timestream):
 
 def output_by_experiment(ordered_dict, input_directory):
     expt_timestream = {}
-    for timestream, (dates, per_missing) in ordered_dict.iteritems():
-        experiment = timestream.split(path.sep)[-1].split('-')[0]
+    for timestream in ordered_dict:
+        experiment = path.basename(timestream).split('-')[0]
 
         if path.isdir(input_directory + path.sep + experiment):
-            try:
-                expt_timestream[experiment].append(timestream)
-            except KeyError as e:
-                expt_timestream[experiment] = [timestream]
-    d = {}
-    for experiment, timestreams in expt_timestream.iteritems():
+            expt_timestream.setdefault(experiment, []).append(timestream)
+    d = defaultdict(dict)
+    for experiment, timestreams in expt_timestream.items():
         count = 0
         for timestream in timestreams:
             dates, per_missing = ordered_dict[timestream]
-            for (x, y) in zip(dates, per_missing):
-                try:
-                    d[x.strftime("%Y-%m-%d")][timestream] = y + count
-                except:
-                    d[x.strftime("%Y-%m-%d")] = {}
-                    d[x.strftime("%Y-%m-%d")][timestream] = y + count
+            for (x, y) in zip(dates.tolist(), per_missing.tolist()):
+                d[x.strftime("%Y-%m-%d")][timestream] = y + count
             count += 1
         with open(input_directory + path.sep + experiment + path.sep + experiment + "_missing_images.csv",
-                  'w+') as csvfile:
+                  'w', 1 << 20) as csvfile:
             field_names = ["date"]
             for timestream in timestreams:
-                field_names.append(timestream.split(path.sep)[-1])
+                field_names.append(path.basename(timestream))
             writer = csv.writer(csvfile, lineterminator='\n')
             output = []
             writer.writerow(field_names)
-            for date, timestreams in d.iteritems():
+            for date, timestreams in d.items():
                 row = [date]
-                for timestream, perc in ordered_dict.iteritems():
+                for timestream in ordered_dict:
                     if timestream in expt_timestream[experiment]:
-                        if timestream in timestreams.keys() :
+                        if timestream in timestreams:
                             perc = timestreams[timestream]
                             row.append(perc)
                         else:
@@ -355,12 +488,10 @@ def output_by_experiment(ordered_dict, input_directory):
                     if item != "":
                         output.append(row)
                         break
-            output = sorted(output)
-            for line in output:
-                writer.writerow(line)
+            writer.writerows(sorted(output))
 
 
-def main(input_directory, output_directory, threads):
+def main(input_directory, output_directory, threads, cache_dir=None):
     print("Using {} threads".format(threads))
     if input_directory[-1] == path.sep:
         input_directory = input_directory[:-1]
@@ -370,10 +501,28 @@ def main(input_directory, output_directory, threads):
     print("Finding timestreams in " + input_directory)
     all_timestreams = find_timestreams(input_directory)
     all_missing_images = {}
-    pool = multiprocessing.Pool(threads)
+    if cache_dir:
+        try:
+            if not path.isdir(cache_dir):
+                makedirs(cache_dir)
+        except OSError:
+            print("Can't make cache directory " + cache_dir + ", not caching")
+            cache_dir = None
+    audit = partial(timestream_function, cache_dir=cache_dir)
     if threads > len(all_timestreams):
-        threads = len(all_timestreams)
-    for count, b in enumerate(pool.imap(timestream_function, all_timestreams)):
+        threads = max(1, len(all_timestreams))
+    if threads == 1:
+        # No worker to start, or to pickle each timestream's results back from
+        results = [audit(timestream) for timestream in all_timestreams]
+    else:
+        pool = multiprocessing.Pool(threads)
+        # Results are keyed by timestream, so take them in whatever order they finish
+        chunksize = max(1, len(all_timestreams) // (threads * 4))
+        results = list(pool.imap_unordered(audit, all_timestreams,
+                                           chunksize=chunksize))
+        pool.close()
+        pool.join()
+    for b in results:
         if (b[0]):
             all_missing_images[b[0]] = (b[1], b[2])
     # for timestream in all_timestreams:
@@ -397,13 +546,8 @@ def main(input_directory, output_directory, threads):
     #         print("No images in this timestream")
     print("")
     print("Outputting Overall csv and graph")
-    start_date = all_missing_images.itervalues().next()[0][0]
-    end_date = all_missing_images.itervalues().next()[0][-1]
-    for timestream, (dates, per_missing) in all_missing_images.iteritems():
-        if dates[0] < start_date:
-            start_date = dates[0]
-        if dates[-1] > end_date:
-            end_date = dates[-1]
+    start_date = min(dates[0] for dates, per_missing in all_missing_images.values()).tolist()
+    end_date = max(dates[-1] for dates, per_missing in all_missing_images.values()).tolist()
     ordered_dict = OrderedDict(sorted(all_missing_images.items()))
     output_by_experiment(ordered_dict, input_directory)
     output_all_missing_images(ordered_dict, output_directory, start_date, end_date)
@@ -416,4 +560,4 @@ def main(input_directory, output_directory, threads):
 
 if __name__ == "__main__":
     opts = cli_options()
-    main(opts.directory, opts.output, opts.threads)
+    main(opts.directory, opts.output, opts.threads, opts.cache)
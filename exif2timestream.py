@@ -5,19 +5,33 @@
 from __future__ import print_function
 # Standard library imports
 import argparse
+import calendar
 import csv
 import datetime
+import errno
 import inspect
+import io
+from itertools import repeat
 import json
 import logging
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import shutil
 import sys
-from time import strptime, strftime, mktime, localtime, struct_time, time, sleep
+from time import strptime, strftime, mktime, localtime, gmtime, struct_time, time, sleep, daylight
 import warnings
 import struct
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 has it from the scandir package
+    from scandir import scandir
 # Module imports
 import pexif
 import exifread
@@ -25,6 +39,9 @@ from PIL import Image
 
 # global logger
 log = logging.getLogger("exif2timestream")
+# PIL warns about odd EXIF and very large images, which are expected here.
+# catch_warnings isn't thread safe, so the filter is set once for good.
+warnings.filterwarnings("ignore", module=r"PIL\.")
 
 # Constants
 EXIF_DATE_TAG = "Image DateTime"
@@ -43,7 +60,31 @@ IMAGE_TYPE_CONSTANTS = {"raw", "jpg", "cor", "seg"}
 RAW_FORMATS = {"cr2", "nef", "tif", "tiff", "raw"}
 IMAGE_SUBFOLDERS = {"raw", "jpg", "png", "tiff", "nef", "cr2"}
 DATE_NOW_CONSTANTS = {"now", "current"}
+# Linux ioctl asking the filesystem to share src's extents with dst (reflink)
+FICLONE = 0x40049409
+# Minutes outside the experiment's dates that a date read from a file name
+# must be, for the image to be skipped without reading its EXIF
+FILENAME_DATE_MARGIN = 60
+# Regexes for the date mask directives that file name dates can use
+MASK_DIRECTIVES = {"%Y": r"(\d{4})", "%m": r"(\d{2})", "%d": r"(\d{2})",
+                   "%H": r"(\d{2})", "%M": r"(\d{2})", "%S": r"(\d{2})"}
+MASK_DIRECTIVE_RE = re.compile("|".join(MASK_DIRECTIVES))
+# A config file date, YYYY_MM_DD, as strptime's "%Y_%m_%d" reads it
+CONFIG_DATE_RE = re.compile(r"(\d{4})_(\d{1,2})_(\d{1,2})\Z")
 ongoing = False
+# Compiled file name date regexes and directives, by their date mask
+_mask_regexes = {}
+# Timestream names and output directories, by camera fields, step and res
+_ts_paths = {}
+# Archive directories, by camera fields and step
+_archive_dirs = {}
+# Image dates as read by _read_file_date, by path, mtime, size and date mask,
+# kept for one process_camera call (pool workers keep their own), and to at
+# most FILE_DATES_MAX images
+_file_dates = {}
+FILE_DATES_MAX = 1 << 16
+# Camera-wide arguments to process_image, set by _init_worker
+_worker_state = {}
 
 
 def cli_options():
@@ -53,6 +94,9 @@ def cli_options():
                         help='Print version information.')
     parser.add_argument('-t', '--threads', type=int, default=1,
                         help='Number of processes to use.')
+    parser.add_argument('--io-bound', action='store_true',
+                        help='Use threads rather than processes, for '
+                             'images on slow or network storage.')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Enable debug logging (to file).')
     parser.add_argument('-l', '--logdir',
@@ -64,6 +108,15 @@ def cli_options():
     return parser.parse_args()
 
 
+def _config_date(x):
+    """Parse a config file date to a struct_time, without strptime's overhead."""
+    match = CONFIG_DATE_RE.match(x)
+    if match is None:
+        # Leave anything unusual to strptime, to accept or reject
+        return strptime(x, "%Y_%m_%d")
+    return datetime.date(*(int(g) for g in match.groups())).timetuple()
+
+
 def date(x):
     """Converter / validator for date field."""
     if isinstance(x, struct_time):
@@ -71,7 +124,7 @@ def date(x):
     if x.lower() in DATE_NOW_CONSTANTS:
         return localtime()
     try:
-        return strptime(x, "%Y_%m_%d")
+        return _config_date(x)
     except:
         raise ValueError
 
@@ -88,7 +141,7 @@ def date_end(x):
     else:
         ongoing = False
     try:
-        return strptime(x, "%Y_%m_%d")
+        return _config_date(x)
     except:
         raise ValueError
 
@@ -230,28 +283,34 @@ class CameraFields(object):
                 "expt_start", "image_types", "interval", "location",
                 "archive_dest", "method", "source"}
     SCHEMA = dict((a, c) for a, b, c in ts_csv_fields)
+    # Field names as written in structures, and a regex matching any of them
+    # (longest first, so that USE doesn't match the start of USER)
+    UPPER_FIELDS = dict((a.upper(), a) for a, b, c in ts_csv_fields)
+    UPPER_FIELDS_RE = re.compile("|".join(
+        sorted(map(re.escape, UPPER_FIELDS), key=len, reverse=True)))
 
     def __init__(self, csv_config_dict):
         """Store csv settings as object attributes and validate."""
-        csv_config_dict = {self.CSV_TS[k]: v for k, v in
-                           csv_config_dict.items() if k in self.CSV_TS}
+        # Translate, validate and set each known field in a single pass
+        fields = set()
+        for csv_key, value in csv_config_dict.items():
+            key = self.CSV_TS.get(csv_key)
+            if key is not None:
+                setattr(self, key, self.SCHEMA[key](value))
+                fields.add(key)
         # Set default properties
-        if 'interval' not in csv_config_dict:
-            csv_config_dict['interval'] = 1
-        if 'method' not in csv_config_dict:
-            csv_config_dict['method'] = 'archive'
+        if 'interval' not in fields:
+            self.interval = 1
+            fields.add('interval')
+        if 'method' not in fields:
+            self.method = 'archive'
+            fields.add('method')
         # Ensure required properties are included, and no unknown attributes
-        if not all(key in csv_config_dict for key in self.REQUIRED):
+        if not self.REQUIRED <= fields:
             raise ValueError('CSV config dict lacks required key/s.')
         # TODO: re-enable correctly, to catch illegal keys
         #        if any(key not in self.TS_CSV for key in csv_config_dict):
         #            raise ValueError('CSV config dict has unknown key/s.')
-        # Converts dict keys and calls validation function on each value
-        csv_config_dict = {k: self.SCHEMA[k](v)
-                           for k, v in csv_config_dict.items()}
-        # Set object attributes from config
-        for k, v in csv_config_dict.items():
-            setattr(self, self.CSV_TS[k] if k in self.CSV_TS else k, v)
 
         # Localise pathnames
         def local(p):
@@ -261,7 +320,7 @@ class CameraFields(object):
         self.source = local(self.source)
         self.archive_dest = local(self.archive_dest)
         self.destination = local(self.destination)
-        log.debug("Validated camera '{}'".format(csv_config_dict))
+        log.debug("Validated camera '%s'", csv_config_dict)
 
 
 class SkipImage(StopIteration):
@@ -284,7 +343,9 @@ def d2s(date):
 def resolution_calc(camera, image):
     x = 0
     try:
-        camera.resolutions[0] = Image.open(image).size
+        # Opening only reads the header, and the with closes the file again
+        with Image.open(image) as img:
+            camera.resolutions[0] = img.size
     except IOError:
         with open(image, "rb") as fh:
             exif_tags = exifread.process_file(
@@ -335,18 +396,13 @@ def create_small_json(res, camera, full_res, image_resolution, p_start, p_end, t
     else:
         lower_resolution = False
         low_res = res
-    if not os.path.exists(os.path.join(camera.destination, camera.ts_structure.format(folder=folder,
-                                                                                      res=res, step=step))):
-        os.makedirs(os.path.join(camera.destination, camera.ts_structure.format(folder=folder,
-                                                                                res=res, step=step)))
-    if os.path.isfile(os.path.join(camera.destination, camera.ts_structure.format(folder=folder,
-                                                                                  res=res, step=step),
-                                   camera.userfriendlyname + '-ts-info.json')):
-        old_json = open(os.path.join(camera.destination, camera.ts_structure.format(folder=folder,
-                                                                                    res=res, step=step),
-                                     camera.userfriendlyname + '-ts-info.json'), 'r')
-        jdump = eval(old_json.read().replace("null", "None"))
-        old_json.close()
+    ts_dir = os.path.join(camera.destination, camera.ts_structure.format(folder=folder,
+                                                                         res=res, step=step))
+    ensure_dir(ts_dir)
+    json_path = os.path.join(ts_dir, camera.userfriendlyname + '-ts-info.json')
+    if os.path.isfile(json_path):
+        with open(json_path) as old_json:
+            jdump = json.load(old_json)
         if jdump['posix_start'] > mktime(p_start):
             jdump['posix_start'] = mktime(p_start)
             jdump['ts_start'] = strftime(TS_DATE_FMT, p_start)
@@ -400,20 +456,24 @@ def create_small_json(res, camera, full_res, image_resolution, p_start, p_end, t
             'utc': 'false',
         }
 
-    small_json = open(os.path.join(camera.destination, camera.ts_structure.format(folder=folder,
-                                                                                  res=res, step=step),
-                                   camera.userfriendlyname + '-ts-info.json'), 'wb+')
-    json.dump(jdump, small_json)
-    small_json.close()
+    with open(json_path, 'w', buffering=1 << 20) as small_json:
+        json.dump(jdump, small_json)
 
 
 def parse_structures(camera):
+    def fill_fields(structure):
+        """Replace each upper-case field name in structure with its value."""
+        def value(match):
+            key = CameraFields.UPPER_FIELDS[match.group()]
+            if key not in camera.__dict__:
+                return match.group()
+            return str(camera.__dict__[key])
+        return CameraFields.UPPER_FIELDS_RE.sub(value, structure)
+
     if len(camera.userfriendlyname) < 1:
         camera.userfriendlyname = '{}-{}-C{}{}'.format(camera.expt, camera.location, camera.cam_num, camera.datasetID)
     else:
-        for key, value in camera.__dict__.items():
-            camera.userfriendlyname = camera.userfriendlyname.replace(key.upper(),
-                                                                      str(value))
+        camera.userfriendlyname = fill_fields(camera.userfriendlyname)
         camera.userfriendlyname = camera.userfriendlyname.replace(os.path.sep, '')
 
     """Parse the file structure of the camera for conversion to timestream
@@ -433,9 +493,7 @@ def parse_structures(camera):
 
     else:
         # Replace the ts_structure with all the other stuff
-        for key, value in camera.__dict__.items():
-            camera.ts_structure = camera.ts_structure.replace(key.upper(),
-                                                              str(value))
+        camera.ts_structure = fill_fields(camera.ts_structure)
         # If it starts with a /, then we need to get rid of that
         if camera.ts_structure[0] == os.path.sep:
             camera.ts_structure = camera.ts_structure[1:]
@@ -453,9 +511,7 @@ def parse_structures(camera):
                               camera.datasetID + \
                               '~{res}-{step}'
     else:
-        for key, value in camera.__dict__.items():
-            camera.fn_structure = camera.fn_structure.replace(key.upper(),
-                                                              str(value))
+        camera.fn_structure = fill_fields(camera.fn_structure)
         camera.fn_structure = camera.fn_structure.replace(os.path.sep, "") \
                                   .replace("_", "-") + '~{res}-{step}'
     return camera
@@ -465,29 +521,30 @@ def resize_function(camera, image_date, dest, img_array, step="orig"):
     """Create a resized image in a new location."""
     log.debug("Now checking if we have 1 or 2 resolution arguments on '{}'"
               .format(dest))
+    if camera.resolutions[1:] and hasattr(img_array, "draft"):
+        # An unloaded JPEG can be decoded at 1/2, 1/4 or 1/8 scale, so only
+        # decode it as large as the biggest resize needs
+        img_array.draft(img_array.mode,
+                        (max(res[0] for res in camera.resolutions[1:]),
+                         max(res[1] for res in camera.resolutions[1:])))
     for resize_resolution in camera.resolutions[1:]:
         new_res = resize_resolution
         log.debug("Two resolution arguments, "
                   "'{}' x '{}'".format(new_res[0], new_res[1]))
         log.info("Now getting Timestream name")
-        ts_name = make_timestream_name(camera, res=new_res[camera.orientation in ("90", "270")], step=step)
-        resizing_temp_outname = get_new_file_name(image_date, ts_name)
-        resized_img = os.path.join(
-            camera.destination,
-            camera.ts_structure.format(folder='outputs', res=str(new_res[camera.orientation in ("90", "270")]),
-                                       cam=camera.cam_num, step=step),
-            resizing_temp_outname)
+        ts_name, ts_dir = _timestream_paths(
+            camera, step, res=new_res[camera.orientation in ("90", "270")])
+        resized_img = os.path.join(ts_dir, get_new_file_name(image_date, ts_name))
         if os.path.isfile(resized_img):
             return
         log.debug("Full resized filename for output is '{}'".format(resized_img))
         resized_img_path = os.path.dirname(resized_img)
-        if not os.path.exists(resized_img_path):
-            try:
-                os.makedirs(resized_img_path)
-            except OSError:
-                log.warn("Could not make dir '{}', skipping image '{}'"
-                         .format(resized_img_path, resized_img))
-                # raise SkipImage
+        try:
+            ensure_dir(resized_img_path)
+        except OSError:
+            log.warn("Could not make dir '{}', skipping image '{}'"
+                     .format(resized_img_path, resized_img))
+            # raise SkipImage
         log.debug("Now actually resizing image to '{}'".format(resized_img))
         resize_img(dest, resized_img, new_res[0], new_res[1], img_array)
 
@@ -497,37 +554,77 @@ def resize_img(filename, destination, to_width, to_height, img_array):
     img = img_array.resize((to_width, to_height))
     log.debug("Now resizing the image")
     log.debug("Saving Image")
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        img.save(destination)
+    # Encode in memory, so the exif is added before the only write to disk.
+    # Resized images are always named .jpg, as pexif needs them to be.
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG")
+    data = buf.getvalue()
     # Write new exif data from old image
     try:
         exif_source = pexif.JpegFile.fromFile(filename)
-        exif_dest = pexif.JpegFile.fromFile(destination)
-        exif_dest.exif.primary.ExtendedEXIF.DateTimeOriginal = \
-            exif_source.exif.primary.ExtendedEXIF.DateTimeOriginal
-        exif_dest.exif.primary.Orientation = \
-            exif_source.exif.primary.Orientation
-        exif_dest.writeFile(destination)
+        exif_dest = pexif.JpegFile(io.BytesIO(data), filename=destination)
+        source = exif_source.exif.primary
+        dest = exif_dest.exif.primary
+        # pexif raises AttributeError for tags the original doesn't have
+        date_time = getattr(source.ExtendedEXIF, "DateTimeOriginal", None)
+        if date_time is not None:
+            dest.ExtendedEXIF.DateTimeOriginal = date_time
+        orientation = getattr(source, "Orientation", None)
+        if orientation is not None:
+            dest.Orientation = orientation
+        out = io.BytesIO()
+        exif_dest.writeFd(out)
+        data = out.getvalue()
         log.debug("Successfully copied exif data also")
-    except (AttributeError, pexif.JpegFile.InvalidFile, struct.error, IOError):
+    except (pexif.JpegFile.InvalidFile, struct.error, IOError):
         log.debug("Unable to copy over some exif data")
+    with open(destination, "wb") as fh:
+        fh.write(data)
+
+
+def _mask_regex(mask):
+    """Compile a date mask to a regex, and the directives its groups hold.
+
+    The directives are None if the mask has anything besides the numeric
+    directives and plain characters, which only strptime can check.
+    """
+    directives = MASK_DIRECTIVE_RE.findall(mask)
+    body = MASK_DIRECTIVE_RE.sub(lambda m: MASK_DIRECTIVES[m.group(0)], mask)
+    literals = MASK_DIRECTIVE_RE.split(mask)
+    if (len(set(directives)) < len(directives) or
+            any("%" in part or re.escape(part) != part for part in literals)):
+        directives = None
+    return re.compile(r"(\.*" + body + r"\.*)"), directives
 
 
 def get_time_from_filename(filename, mask=None):
     """Replaces time placeholders with the regex equivalent to parse."""
-    global DATE_MASK
-    if len(mask) is 0:
+    if not mask:
         mask = DATE_MASK
-    mask_r = r"\.*" + mask.replace("%Y", r"\d{4}") + r"\.*"
-    for s in ('%m', '%d', '%H', '%M', '%S'):
-        mask_r = mask_r.replace(s, r'\d{2}')
-    date_reg_exp = re.compile(mask_r)
-    for match in date_reg_exp.findall(filename):
+    compiled = _mask_regexes.get(mask)
+    if compiled is None:
+        compiled = _mask_regexes[mask] = _mask_regex(mask)
+    date_reg_exp, directives = compiled
+    for match in date_reg_exp.finditer(filename):
         # Attempt to parse each match into a datetime; return first success
+        date_str = match.group()
+        if directives is not None:
+            if date_str.startswith(".") or date_str.endswith("."):
+                # strptime has never accepted the dots around a date
+                continue
+            # The regex has already checked every character, so only the
+            # numbers need checking, which datetime does more cheaply
+            fields = dict(zip(directives, map(int, match.groups()[1:])))
+            try:
+                return datetime.datetime(
+                    fields.get("%Y", 1900), fields.get("%m", 1),
+                    fields.get("%d", 1), fields.get("%H", 0),
+                    fields.get("%M", 0), fields.get("%S", 0)).timetuple()
+            except ValueError:
+                # Leave anything unusual, like leap seconds, to strptime
+                pass
         try:
-            datetime = strptime(match, mask)
-            return datetime
+            return strptime(date_str, mask)
         except ValueError:
             continue
 
@@ -544,16 +641,69 @@ def write_exif_date(filename, date_time):
         return False
 
 
-def get_file_date(filename, timeshift, round_secs=1, date_mask=DATE_MASK):
-    """Gets a time.struct_time from an image's EXIF, or None if not possible.
+def _ifd_entry(tiff, order, offset, tag):
+    """Return the (type, count, value bytes) of tag in the IFD at offset."""
+    count, = struct.unpack(order + "H", tiff[offset:offset + 2])
+    for entry in range(offset + 2, offset + 2 + 12 * count, 12):
+        entry_tag, entry_type, entry_count, value = struct.unpack(
+            order + "HHL4s", tiff[entry:entry + 12])
+        if entry_tag == tag:
+            return entry_type, entry_count, value
+    return None
+
+
+def read_exif_date(filename):
+    """Return a JPEG's EXIF DateTimeOriginal string, or None if it has none.
+
+    Only the segments up to the EXIF one are read, and only the IFDs on the
+    way to the one tag are walked, rather than parsing the whole file.
     """
+    with open(filename, "rb") as fh:
+        if fh.read(2) != b"\xff\xd8":
+            return None
+        while True:
+            marker, length = struct.unpack(">2sH", fh.read(4))
+            # Metadata all comes before the image data starts
+            if marker[:1] != b"\xff" or marker in (b"\xff\xda", b"\xff\xd9"):
+                return None
+            if marker == b"\xff\xe1":
+                segment = fh.read(length - 2)
+                if segment[:6] == b"Exif\x00\x00":
+                    break
+            else:
+                fh.seek(length - 2, os.SEEK_CUR)
+    tiff = segment[6:]
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None:
+        return None
+    # IFD0 points to the EXIF IFD, which holds DateTimeOriginal
+    ifd0, = struct.unpack(order + "L", tiff[4:8])
+    exif_ifd = _ifd_entry(tiff, order, ifd0, 0x8769)
+    if exif_ifd is None:
+        return None
+    exif_offset, = struct.unpack(order + "L", exif_ifd[2])
+    original = _ifd_entry(tiff, order, exif_offset, 0x9003)
+    if original is None:
+        return None
+    entry_type, count, value = original
+    if count > 4:
+        offset, = struct.unpack(order + "L", value)
+        value = tiff[offset:offset + count]
+    try:
+        return value[:count].split(b"\x00")[0].decode("ascii") or None
+    except UnicodeDecodeError:
+        return None
+
+
+def _read_file_date(filename, date_mask):
+    """Read an image's date from its EXIF or name, before rounding or shifting."""
     date = None
     try:
-        exif_tags = pexif.JpegFile.fromFile(filename)
-        str_date = exif_tags.exif.primary.ExtendedEXIF.DateTimeOriginal
-        date = strptime(str_date, EXIF_DATE_FMT)
-    except (AttributeError, pexif.JpegFile.InvalidFile, struct.error):
-        # print ("failed pexif")
+        str_date = read_exif_date(filename)
+        if str_date:
+            date = strptime(str_date, EXIF_DATE_FMT)
+    except struct.error:
+        # Truncated or malformed, so leave it to exifread
         pass
     if not date:
         with open(filename, "rb") as fh:
@@ -578,6 +728,24 @@ def get_file_date(filename, timeshift, round_secs=1, date_mask=DATE_MASK):
         else:
             if not write_exif_date(filename, date):
                 log.debug("Unable to write Exif Data")
+    return date
+
+
+def get_file_date(filename, timeshift, round_secs=1, date_mask=DATE_MASK):
+    """Gets a time.struct_time from an image's EXIF, or None if not possible.
+    """
+    # An unchanged file has the same date, so each is only read once
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime, stat.st_size, date_mask)
+    if key in _file_dates:
+        date = _file_dates[key]
+    else:
+        if len(_file_dates) >= FILE_DATES_MAX:
+            # Dates are reused soon after they're read, if at all
+            _file_dates.clear()
+        date = _file_dates[key] = _read_file_date(filename, date_mask)
+    if date is None:
+        return None
     if round_secs > 1:
         date = round_struct_time(date, round_secs)
     if (timeshift and (int)(timeshift)):
@@ -605,16 +773,26 @@ def get_new_file_name(date_tuple, ts_name, n=0, fmt=TS_FMT, ext="jpg"):
 def round_struct_time(in_time, round_secs, tz_hrs=0, uselocal=True):
     """Round a struct_time object to any time interval in seconds."""
     # TODO:  replace use of time module with more reliable datetime
-    seconds = mktime(in_time)
-    rounded = int(round(seconds / float(round_secs)) * round_secs)
-    if not uselocal:
-        rounded -= tz_hrs * 60 * 60  # remove tz seconds, back to UTC
-    rv_list = list(localtime(rounded))
+    seconds = int(mktime(in_time))
+    rounded, rem = divmod(seconds, round_secs)
+    # Round half to even, as round() does
+    if rem * 2 > round_secs or (rem * 2 == round_secs and rounded % 2):
+        rounded += 1
+    rounded *= round_secs
+    if uselocal and not daylight:
+        # With no DST the UTC offset doesn't change, so the fields can just
+        # be shifted, rather than converted back with localtime
+        rv_list = list(gmtime(calendar.timegm(in_time) + rounded - seconds))
+    else:
+        if not uselocal:
+            rounded -= tz_hrs * 60 * 60  # remove tz seconds, back to UTC
+        rv_list = list(localtime(rounded))
     rv_list[8] = in_time.tm_isdst
     rv_list[6] = in_time.tm_wday
     retval = struct_time(tuple(rv_list))
-    log.debug("time {} rounded to {:d} seconds is {}".format(
-        d2s(in_time), round_secs, d2s(retval)))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("time {} rounded to {:d} seconds is {}".format(
+            d2s(in_time), round_secs, d2s(retval)))
     return retval
 
 
@@ -634,49 +812,93 @@ def make_timestream_name(camera, res="fullres", step="orig",
     return ts_name
 
 
-def timestreamise_image(image, camera, subsec=0, step="orig"):
-    """Process a single image, mv/cp-ing it to its new location"""
-    # Edit the global variable for the date mask, used elsewhere
+def _timestream_paths(camera, step, res="fullres"):
+    """Return the timestream name and output directory for a step and res.
+
+    Both depend only on the camera, so they're formatted once per camera,
+    step and resolution, rather than for every image (workers each get
+    their own copy of the camera, so it's keyed on the fields used, not the
+    camera object).
+    """
+    key = (camera.fn_structure, camera.ts_structure, camera.expt,
+           camera.location, camera.cam_num, camera.destination, step, res)
+    paths = _ts_paths.get(key)
+    if paths is None:
+        if res == "fullres" and step in ["orig", "raw"]:
+            folder = 'originals'
+        else:
+            folder = 'outputs'
+        ts_name = make_timestream_name(camera, res=res, step=step)
+        ts_dir = os.path.join(
+            camera.destination,
+            camera.ts_structure.format(folder=folder, res=str(res),
+                                       cam=camera.cam_num, step=step))
+        paths = _ts_paths[key] = (ts_name, ts_dir)
+    return paths
+
+
+def _archive_dir(camera, step):
+    """Return the directory that a camera's originals are archived under."""
+    key = (camera.archive_dest, camera.expt, camera.location, camera.cam_num,
+           camera.datasetID, step)
+    archive_dir = _archive_dirs.get(key)
+    if archive_dir is None:
+        archive_dir = _archive_dirs[key] = os.path.join(
+            camera.archive_dest,
+            camera.expt,
+            (camera.expt + '-' +
+             camera.location + "-C" +
+             camera.cam_num +
+             camera.datasetID + "~fullres-" + (
+             step if step in (RAW_FORMATS | {"cor", "seg"}) else "orig")).replace("_", "-"))
+    return archive_dir
 
-    global DATE_MASK
-    DATE_MASK = camera.filename_date_mask
-    image_date = get_file_date(image, camera.timeshift, camera.interval * 60)
+
+def timestreamise_image(image, camera, subsec=0, step="orig", image_date=None):
+    """Process a single image, mv/cp-ing it to its new location"""
+    if image_date is None:
+        image_date = get_file_date(image, camera.timeshift, camera.interval * 60,
+                                   date_mask=camera.filename_date_mask)
     if not image_date:
         log.warn("Couldn't get date for image {}".format(image))
         raise SkipImage
     in_ext = os.path.splitext(image)[-1].lstrip(".")
-    ts_name = make_timestream_name(camera, res="fullres", step=step)
-    out_image = get_new_file_name(image_date, ts_name, n=subsec, ext=in_ext)
-    out_image = os.path.join(
-        camera.destination,
-        camera.ts_structure.format(folder='originals' if step in ["orig", "raw"] else 'outputs', res='fullres',
-                                   cam=camera.cam_num, step=step),
-        out_image)
+    ts_name, ts_dir = _timestream_paths(camera, step)
+    out_image = os.path.join(ts_dir, get_new_file_name(image_date, ts_name, n=subsec, ext=in_ext))
     # make the target directory
     try:
-        os.makedirs(os.path.dirname(out_image))
+        ensure_dir(os.path.dirname(out_image))
     except OSError:
-        if not os.path.exists(os.path.dirname(out_image)):
-            log.warn("Could not make dir '{}', skipping image '{}'"
-                     .format(os.path.dirname(out_image), image))
-            raise SkipImage
+        log.warn("Could not make dir '{}', skipping image '{}'"
+                 .format(os.path.dirname(out_image), image))
+        raise SkipImage
     # And do the copy
     dest = _dont_clobber(out_image, mode=SkipImage)
+    rotate = step != "raw" and _rotates(camera.orientation)
+    img_array = None
 
     try:
-        shutil.copyfile(image, dest)
-        log.info("Copied '{}' to '{}".format(image, dest))
+        if rotate:
+            # Write the rotated image straight to dest, rather than copying
+            # the original there only to decode and overwrite it
+            img_array = rotate_image(camera.orientation, dest, source=image)
+        if img_array is not None:
+            log.info("Rotated '{}' to '{}".format(image, dest))
+        elif camera.method == "move":
+            # The source is deleted afterwards anyway, so just rename it
+            move_file(image, dest)
+            log.info("Moved '{}' to '{}".format(image, dest))
+        else:
+            copy_file(image, dest)
+            log.info("Copied '{}' to '{}".format(image, dest))
     except:
         log.warn("Couldnt copy '{}' to '{}', skipping image".format(
             image, dest))
         raise SkipImage
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        if camera.orientation and camera.orientation is not 0 and step != "raw":
-            img_array = rotate_image(camera.orientation, dest)
-            write_exif_date(dest, image_date);
-        elif (len(camera.resolutions) > 1) and step != "raw":
-            img_array = Image.open(dest)
+    if rotate:
+        write_exif_date(dest, image_date);
+    elif (len(camera.resolutions) > 1) and step != "raw":
+        img_array = Image.open(dest)
     if len(camera.resolutions) > 1 and step != "raw":
         log.info("Going to resize image '{}'".format(dest))
         try:
@@ -697,9 +919,18 @@ def timestreamise_image(image, camera, subsec=0, step="orig"):
             raise SkipImage
 
 
-def rotate_image(rotation, dest):
+def _rotates(orientation):
+    """Whether an orientation setting turns images at all."""
     try:
-        img = Image.open(dest)
+        return float(orientation) % 360 != 0
+    except (TypeError, ValueError):
+        # Empty, or left for rotate_image to fail on
+        return bool(orientation)
+
+
+def rotate_image(rotation, dest, source=None):
+    try:
+        img = Image.open(source or dest)
         img = img.rotate(float(rotation), expand=1)
         img.save(dest)
         return img
@@ -728,6 +959,90 @@ def _dont_clobber(fn, mode="append"):
     return fn
 
 
+def ensure_dir(dirname):
+    """Make dirname (and parents) unless it's already there."""
+    try:
+        os.makedirs(dirname)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST or not os.path.isdir(dirname):
+            raise
+
+
+def copy_file(src, dst):
+    """Copy src to dst, letting the kernel move the bytes where it can."""
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+            if fcntl is not None:
+                try:
+                    # On btrfs or xfs this shares the data, copying nothing
+                    fcntl.ioctl(out_fd, FICLONE, in_fd)
+                    return
+                except (IOError, OSError):
+                    pass
+            size = os.fstat(in_fd).st_size
+            offset = 0
+            while offset < size:
+                if hasattr(os, "copy_file_range"):
+                    sent = os.copy_file_range(in_fd, out_fd, size - offset,
+                                              offset, offset)
+                else:
+                    sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if sent == 0:
+                    raise OSError(errno.EIO, "Short copy to '{}'".format(dst), src)
+                offset += sent
+    except (AttributeError, IOError, OSError):
+        # No sendfile, or the kernel refused or stopped short on these files
+        shutil.copyfile(src, dst)
+
+
+def move_file(src, dst):
+    """Move src to dst, renaming when both are on the same filesystem."""
+    try:
+        os.rename(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        copy_file(src, dst)
+        # Only drop the source once all of it is in the copy
+        if os.stat(dst).st_size != os.stat(src).st_size:
+            # Nor leave the partial copy where it looks like the image
+            os.unlink(dst)
+            raise IOError(errno.EIO, "Incomplete copy to '{}'".format(dst), src)
+        os.unlink(src)
+
+
+def _named_outside_expt(image, camera):
+    """Whether the date in image's name is well outside the experiment.
+
+    Only cameras with a file name date mask are checked, and the date must
+    be more than FILENAME_DATE_MARGIN minutes (plus an interval, for
+    rounding) out, so that the EXIF date would be out as well.
+    """
+    if not camera.filename_date_mask:
+        return False
+    name_date = get_time_from_filename(os.path.basename(image),
+                                       camera.filename_date_mask)
+    if name_date is None:
+        return False
+    epoch = calendar.timegm(name_date)
+    if camera.timeshift and int(camera.timeshift):
+        epoch += int(camera.timeshift) * 60 * 60
+    margin = (FILENAME_DATE_MARGIN + camera.interval) * 60
+    return (epoch < calendar.timegm(camera.expt_start) - margin or
+            epoch > calendar.timegm(camera.expt_end) + margin)
+
+
+def _init_worker(camera, ext, step):
+    """Stash the camera-wide arguments once per process for _process_path."""
+    _worker_state["args"] = (camera, ext, step)
+
+
+def _process_path(image):
+    """Process an image with the camera-wide arguments _init_worker set."""
+    return process_image((image,) + _worker_state["args"])
+
+
 def process_image(args):
     """Do move and copy operations for a camera config and list of images."""
     log.debug("Starting to process image")
@@ -735,7 +1050,13 @@ def process_image(args):
     while (retry):
         try:
             image, camera, ext, step = args
-            image_date = get_file_date(image, camera.timeshift, camera.interval * 60)
+            method = camera.method
+            if _named_outside_expt(image, camera):
+                log.debug("Skipping {}. Named outside of date range {} to {}".format(
+                    image, d2s(camera.expt_start), d2s(camera.expt_end)))
+                return
+            image_date = get_file_date(image, camera.timeshift, camera.interval * 60,
+                                       date_mask=camera.filename_date_mask)
             if camera.expt_start > image_date or image_date > camera.expt_end:
                 log.debug("Skipping {}. Outside of date range {} to {}".format(
                     image, d2s(camera.expt_start), d2s(camera.expt_end)))
@@ -743,56 +1064,47 @@ def process_image(args):
             my_ext = os.path.splitext(image)[-1].lower().strip(".")
             if not (my_ext == ext) and not ((my_ext in RAW_FORMATS) and (ext == "raw")):
                 return
-            if camera.method == "json":
+            if method == "json":
                 return
             if "last_image" in image.lower():
                 log.debug("Skipping file {}, assumed last image".format(image))
                 return
-            if camera.method == "resize" and (ext not in RAW_FORMATS):
-                img_array = Image.open(image)
-                resize_function(camera, image_date, image, img_array, step=step if step else "orig")
+            if method == "resize" and (ext not in RAW_FORMATS):
+                with Image.open(image) as img_array:
+                    resize_function(camera, image_date, image, img_array, step=step if step else "orig")
                 log.debug("Rezied Image {}".format(image))
-            if camera.method == "rotate" and (ext not in RAW_FORMATS):
-                rotate_image(camera.orientation, image)
+            if method == "rotate" and (ext not in RAW_FORMATS):
+                if _rotates(camera.orientation):
+                    rotate_image(camera.orientation, image)
                 return
-            if camera.method == "archive":
+            if method == "archive":
                 log.debug("Will archive {}".format(image))
-                ts_name = make_timestream_name(camera, res="fullres")
-                out_image = get_new_file_name(image_date, ts_name)
-                archive_image = os.path.join(
-                    camera.archive_dest,
-                    camera.expt,
-                    (camera.expt + '-' +
-                     camera.location + "-C" +
-                     camera.cam_num +
-                     camera.datasetID + "~fullres-" + (
-                     step if step in (RAW_FORMATS | {"cor", "seg"}) else "orig")).replace("_", "-"),
-                    os.path.relpath(image, camera.source))
-                try:
-                    os.makedirs(os.path.dirname(archive_image))
-                    log.debug("Made archive dir {}".format(os.path.dirname(
-                        archive_image)))
-                except OSError as exc:
-                    if not os.path.exists(os.path.dirname(archive_image)):
-                        raise exc
+                archive_image = os.path.join(_archive_dir(camera, step),
+                                             os.path.relpath(image, camera.source))
+                ensure_dir(os.path.dirname(archive_image))
                 archive_image = _dont_clobber(archive_image)
-                shutil.copyfile(image, archive_image)
+                copy_file(image, archive_image)
                 log.debug("Copied {} to {}".format(image, archive_image))
             try:
                 # deal with original image (move/copy etc)
                 timestreamise_image(
                     image, camera, subsec=0,
-                    step=step if step else ("raw" if ext.lower() in RAW_FORMATS else "orig"))
+                    step=step if step else ("raw" if ext.lower() in RAW_FORMATS else "orig"),
+                    image_date=image_date)
                 log.debug("Successfully timestreamed {}".format(image))
             except SkipImage:
+                # The original may be the only whole copy, so keep it
                 log.debug("Failed to timestream {} (got SkipImage)".format(image))
+                return
 
-            if camera.method in {"move", "archive"}:
+            if method in {"move", "archive"}:
                 # images have been archived above, so just delete originals
                 try:
                     os.unlink(image)
-                except OSError:
-                    log.error("Could not delete '{0}'".format(image))
+                except OSError as exc:
+                    # ENOENT if timestreamise_image renamed it into the timestream
+                    if exc.errno != errno.ENOENT:
+                        log.error("Could not delete '{0}'".format(image))
                 log.debug("Deleted {}".format(image))
             retry = 0
         except (struct.error, IOError) as e:
@@ -809,11 +1121,18 @@ def parse_camera_config_csv(filename):
     """Parse a camera configuration, yielding localised and validated
     camera configuration objects."""
     if filename is None:
-        raise StopIteration
-    with open(filename) as fh:
-        cam_config = csv.DictReader(fh)
-        for camera in cam_config:
+        return
+    with open(filename, "r", 1 << 20) as fh:
+        cam_config = csv.reader(fh)
+        header = next(cam_config, [])
+        for row in cam_config:
+            if not row:
+                continue
+            camera = dict(zip(header, row))
             try:
+                # Unused cameras needn't be validated at all
+                if "USE" in camera and not bool_str(camera["USE"]):
+                    continue
                 camera = CameraFields(camera)
                 if camera.use:
                     yield parse_structures(camera)
@@ -822,6 +1141,23 @@ def parse_camera_config_csv(filename):
                 continue
 
 
+def _scandir_walk(src):
+    """Yield a DirEntry for every file below src, in the order os.walk would."""
+    try:
+        entries = list(scandir(src))
+    except OSError:
+        return
+    subdirs = []
+    for entry in entries:
+        if not entry.is_dir():
+            yield entry
+        elif not entry.is_symlink():
+            subdirs.append(entry.path)
+    for subdir in subdirs:
+        for entry in _scandir_walk(subdir):
+            yield entry
+
+
 def find_image_files(camera):
     """Scrape a directory for image files, by extension.
     Possibly, in future, use file magic numbers, but a bad idea on windows.
@@ -829,58 +1165,40 @@ def find_image_files(camera):
     print("Finding Image Files in source Directory {}. ".format(camera.source))
     print("Warning, this can take a while depending on number of images in the directory")
     exts = camera.image_types
-    ext_files = {}
-    count_images = 0
+    # Each extension is walked from its own subdir if there is one, else source
+    ext_roots = dict((ext, camera.source) for ext in exts)
+    for entry in scandir(camera.source):
+        name = entry.name.lower()
+        if name in ext_roots and ext_roots[name] == camera.source and entry.name[0] not in ('.', '_'):
+            log.debug("Found src subdir {}".format(entry.name))
+            ext_roots[name] = entry.path
+    walks = {}
     for ext in exts:
-        src = camera.source
-
-        lst = [x for x in os.listdir(src) if not x[0] in ('.', '_')]
-        log.debug("List of src valid subdirs is {}".format(lst))
-        for node in lst:
-            log.debug("Found src subdir {}".format(node))
-            if node.lower() == ext:
-                src = os.path.join(src, node)
-                break
+        walks.setdefault(ext_roots[ext], []).append(ext)
+    ext_files = dict((ext, []) for ext in exts)
+    count_images = 0
+    # Each tree is read once, however many extensions are found in it
+    for src, src_exts in walks.items():
         log.info("Walking from {} to find images".format(src))
         if (camera.sub_folder):
-            for cur_dir, dirs, files in os.walk(src):
-                # for d in dirs:
-                #     if not (d.lower() in IMAGE_SUBFOLDERS or d.startswith("_")):
-                #         if not camera.method in ("resize", "json"):
-                #             #log.error("Source directory has too many subdirs.")
-
-                for fle in files:
-                    this_ext = os.path.splitext(fle)[-1].lower().strip(".")
-                    if (ext in (this_ext) or (ext == "raw" and this_ext in RAW_FORMATS)) or \
-                            (ext in ["cor", "seg"] and this_ext == 'jpg'):
-                        fle_path = os.path.join(cur_dir, fle)
-                        if camera.fn_parse in fle_path and "last_image" not in fle_path:
-                            count_images += 1
-                            print("Found {:5d} Images".format(count_images), end='\r')
-                            try:
-                                ext_files[ext].append(fle_path)
-                            except KeyError:
-                                ext_files[ext] = []
-                                ext_files[ext].append(fle_path)
-            log.info("Found {0} {1} files for camera.".format(
-                len(ext_files), ext))
+            entries = _scandir_walk(src)
         else:
-            for fle in [f for f in os.listdir(src) if os.path.isfile(os.path.join(src, f))]:
-                this_ext = os.path.splitext(fle)[-1].lower().strip(".")
-                if ext in (this_ext) or (ext == "raw" and this_ext in RAW_FORMATS):
-                    fle_path = os.path.join(src, fle)
+            entries = (entry for entry in scandir(src) if entry.is_file())
+        for entry in entries:
+            this_ext = os.path.splitext(entry.name)[-1].lower().strip(".")
+            for ext in src_exts:
+                if (ext in (this_ext) or (ext == "raw" and this_ext in RAW_FORMATS)) or \
+                        (camera.sub_folder and ext in ["cor", "seg"] and this_ext == 'jpg'):
+                    fle_path = entry.path
                     if camera.fn_parse in fle_path and "last_image" not in fle_path:
                         count_images += 1
                         print("Found {:5d} Images".format(count_images), end='\r')
-                        try:
-                            ext_files[ext].append(fle_path)
-                        except KeyError:
-                            ext_files[ext] = []
-                            ext_files[ext].append(fle_path)
+                        ext_files[ext].append(fle_path)
+        for ext in src_exts:
             log.info("Found {0} {1} files for camera.".format(
-                len(ext_files), ext))
+                len(ext_files[ext]), ext))
 
-    return ext_files
+    return dict((ext, files) for ext, files in ext_files.items() if files)
 
 
 def setup_logs(logdir, debug=False):
@@ -930,7 +1248,8 @@ def get_resolution(image, camera):
                 image_resolution = (0, 0)
         else:
             try:
-                image_resolution = Image.open(image).size
+                with Image.open(image) as img:
+                    image_resolution = img.size
             except ValueError:
                 print("Value Error?")
                 image_resolution = (0, 0)
@@ -943,7 +1262,6 @@ def get_resolution(image, camera):
 def get_thumbnail_paths(camera, images, res, image_resolution, folder, step='orig'):
     """Return thumbnail paths, for the final resting place of the images."""
     if not step: step = 'orig'
-    webrootaddr = ""
     url = "http://phenocam.anu.edu.au/cloud/a_data"
     webrootaddr = "http://phenocam.anu.edu.au/cloud/a_data{}/{}".format(
         camera.destination.split("a_data")[-1],
@@ -957,25 +1275,28 @@ def get_thumbnail_paths(camera, images, res, image_resolution, folder, step='ori
         else:
             max = 3
             start = (len(images) // 2) - 1
+        # Everything but each image's date is the same for every thumbnail
+        ts_name = make_timestream_name(camera, res, step)
+        ts_dirs = [camera.destination, os.path.dirname(camera.ts_structure).format(folder=folder),
+                   os.path.basename(camera.ts_structure).format(res=res, step=step)]
+        if len(camera.resolutions) > 1:
+            thumb_fields = {"folder": "outputs",
+                            "res": camera.resolutions[1][camera.orientation in ("90", "270")]}
+        else:
+            thumb_fields = {"folder": "originals", "res": "orig"}
         for i in range(max):
             try:
+                # Dates are cached, so this doesn't read the image again
                 image_date = get_file_date(images[start + i], camera.timeshift,
-                                           camera.interval * 60)
-                ts_image = get_new_file_name(
-                    image_date, make_timestream_name(camera, res, step))
-                thumb_image.append(sep.join([
-                    camera.destination, os.path.dirname(camera.ts_structure).format(folder=folder),
-                    os.path.basename(camera.ts_structure).format(res=res, step=step), ts_image]).replace("\\", "/"))
+                                           camera.interval * 60,
+                                           date_mask=camera.filename_date_mask)
+                ts_image = get_new_file_name(image_date, ts_name)
+                thumb = sep.join(ts_dirs + [ts_image]).replace("\\", "/")
+                if thumb:
+                    thumb = (url + thumb.split("a_data")[-1]).format(**thumb_fields)
+                thumb_image.append(thumb)
             except (SkipImage):
                 pass
-    for i in range(len(thumb_image)):
-        if thumb_image[i]:
-            thumb_image[i] = url + thumb_image[i].split("a_data")[-1]
-            if len(camera.resolutions) > 1:
-                thumb_image[i] = thumb_image[i].format(folder="outputs",
-                                                       res=camera.resolutions[1][camera.orientation in ("90", "270")])
-            else:
-                thumb_image[i] = thumb_image[i].format(folder="originals", res="orig")
     return webrootaddr, thumb_image
 
 
@@ -991,7 +1312,8 @@ def get_actual_start_end(camera, images, ext):
         elif (my_ext in RAW_FORMATS) and (ext == "raw"):
             my_ext_images.append(image);
     while earlier and (j <= len(my_ext_images) - 1):
-        date = get_file_date(my_ext_images[j], camera.timeshift, camera.interval * 60)
+        date = get_file_date(my_ext_images[j], camera.timeshift, camera.interval * 60,
+                             date_mask=camera.filename_date_mask)
         if (date >= camera.expt_start) and (date is not None):
             earlier = False
         j += 1
@@ -1002,7 +1324,8 @@ def get_actual_start_end(camera, images, ext):
     j = len(my_ext_images) - 1
     date = None
     while later and j >= 0:
-        date = get_file_date(my_ext_images[j], camera.timeshift, camera.interval * 60)
+        date = get_file_date(my_ext_images[j], camera.timeshift, camera.interval * 60,
+                             date_mask=camera.filename_date_mask)
         if (date <= camera.expt_end) and (date is not None):
             later = False
         j -= 1
@@ -1013,15 +1336,58 @@ def get_actual_start_end(camera, images, ext):
 
 
 def find_empty_dirs(root_dir):
+    """Remove every directory under root_dir left empty (bar a thumbs.db)."""
+    removed = set()
     for dirpath, dirs, files in os.walk(root_dir, topdown=False):
-        if (len(files) is 1 and "thumbs.db" in files):
+        if files == ["thumbs.db"]:
             os.remove(os.path.join(dirpath, "thumbs.db"))
-        if (not dirs and not files) or len(os.listdir(dirpath)) == 0:
+            files = []
+        # The walk is bottom-up, so subdirs have already been dealt with;
+        # this avoids listing each directory a second time.
+        if not files and all(os.path.join(dirpath, d) in removed
+                             for d in dirs):
             os.rmdir(dirpath)
+            removed.add(dirpath)
+
+
+def _pool_size(n_threads):
+    """Return how many worker processes to use, leaving a core for the parent."""
+    return max(1, min(n_threads, multiprocessing.cpu_count() - 1))
 
 
-def process_camera(camera, ext, images, n_threads=1):
-    """Process a set of images for one extension for a single camera."""
+def _start_pool(n_threads, io_bound=False, initargs=None):
+    """Start a pool of worker processes, or of threads if io_bound.
+
+    File reads and copies release the GIL, so when they dominate threads
+    do as well as processes, without pickling every task and result.
+    If initargs are given, each worker passes them to _init_worker.
+    """
+    threads = _pool_size(n_threads)
+    initializer = _init_worker if initargs is not None else None
+    if io_bound:
+        log.info("Using {0:d} threads".format(threads))
+        return ThreadPool(threads, initializer=initializer, initargs=initargs or ())
+    log.info("Using {0:d} processes".format(threads))
+    # Recycle each worker now and then, so leaked files and memory don't pile up
+    return multiprocessing.Pool(threads, initializer=initializer,
+                                initargs=initargs or (), maxtasksperchild=1000)
+
+
+def process_camera(camera, ext, images, n_threads=1, pool=None):
+    """Process a set of images for one extension for a single camera.
+
+    If a pool of worker processes is passed it's used instead of starting
+    one, and left open for the caller to reuse.
+    """
+    try:
+        return _process_camera(camera, ext, images, n_threads, pool)
+    finally:
+        # Image dates are only reused within one camera's images
+        _file_dates.clear()
+
+
+def _process_camera(camera, ext, images, n_threads, pool):
+    """Process one camera's images of one extension, for process_camera."""
     if ext in ["cor", "seg"]:
         step = ext
         ext = 'jpg'
@@ -1033,46 +1399,62 @@ def process_camera(camera, ext, images, n_threads=1):
             if ("fullres" in image):
                 new_images.append(image)
         images = new_images
+    portrait = camera.orientation in ("90", "270")
     p_start, p_end = get_actual_start_end(camera, images, ext)
     try:
-        my_image = (x for x in images if ((os.path.splitext(x)[-1].lower().strip(".") == ext) or (
-        os.path.splitext(x)[-1].lower().strip(".") in RAW_FORMATS and ext == "raw"))).next()
+        my_image = next(x for x in images if ((os.path.splitext(x)[-1].lower().strip(".") == ext) or (
+        os.path.splitext(x)[-1].lower().strip(".") in RAW_FORMATS and ext == "raw")))
     except StopIteration:
         return
     camera = resolution_calc(camera, my_image)
     res, image_resolution, folder = get_resolution(my_image, camera)
     if (len(camera.resolutions) > 1):
-        low_res = camera.resolutions[1][camera.orientation in ("90", "270")]
+        low_res = camera.resolutions[1][portrait]
         low_folder = "outputs"
     else:
         low_res = "fullres"
         low_folder = "originals"
     webrootaddr, thumb_image = get_thumbnail_paths(camera, images, low_res, image_resolution, low_folder, step=step)
-    webrootaddr = webrootaddr.replace("\\", "/")
 
     # TODO: sort out the whole subsecond clusterfuck
+    if (n_threads != 1 and pool is None and
+            len(images) < max(_pool_size(n_threads) * 4, 32)):
+        # Too few images to be worth starting a pool of processes for
+        log.debug("Only {} images, so not starting a pool".format(len(images)))
+        n_threads = 1
     if n_threads == 1:
         log.info("Using 1 process - what is this? 1990?")
         for count, image in enumerate(images):
-            print("Processed {:5d} Images".format(count), end='\r')
-
+            if count % 256 == 0:
+                print("Processed {:5d} Images".format(count), end='\r')
             process_image((image, camera, ext, step))
     else:
-        threads = max(1, min(n_threads, multiprocessing.cpu_count() - 1))
-        log.info("Using {0:d} processes".format(threads))
-        # set the function's camera-wide arguments
-        args = ((image, camera, ext, step) for image in images)
-        pool = multiprocessing.Pool(threads)
-        for count, _ in enumerate(pool.imap(process_image, args)):
-            print("Processed {:5d} Images".format(count), end='\r')
-        pool.close()
-        pool.join()
-    print("Processed {:5d} Images. Finished this cam!".format(count))
+        own_pool = pool is None
+        if own_pool:
+            # Each worker is given the camera-wide arguments once, so only
+            # the image paths are sent with the tasks
+            pool = _start_pool(n_threads, initargs=(camera, ext, step))
+            func, args = _process_path, images
+        else:
+            # A shared pool outlives this camera, so its arguments go with
+            # each batch, where pickle sends the camera only the once
+            func = process_image
+            args = zip(images, repeat(camera), repeat(ext), repeat(step))
+        # Images go out in batches, and come back in whatever order they finish
+        chunksize = max(16, len(images) // (_pool_size(n_threads) * 4))
+        for count, _ in enumerate(pool.imap_unordered(func, args,
+                                                      chunksize=chunksize)):
+            if count % 256 == 0:
+                print("Processed {:5d} Images".format(count), end='\r')
+        if own_pool:
+            pool.close()
+            pool.join()
+    print("Processed {:5d} Images. Finished this cam!".format(len(images)))
     if (ongoing):
         ts_end_text = "now"
     else:
         ts_end_text = strftime(TS_DATE_FMT, p_end)
-    if camera.orientation in ("90", "270"):
+    if portrait:
         fullres = (image_resolution[1], image_resolution[0])
     else:
         fullres = image_resolution
@@ -1108,8 +1490,7 @@ def process_camera(camera, ext, images, n_threads=1):
         'utc': "false",
         'webroot_hires': (
         webrootaddr.format(folder="originals" if step in ["orig", "raw"] else "outputs", res="fullres", step=step)),
-        'webroot': webrootaddr.format(folder="outputs", res=new_res[camera.orientation in ("90",
-                                                                                           "270")], step=step),
+        'webroot': webrootaddr.format(folder="outputs", res=new_res[portrait], step=step),
         'width_hires': fullres[0],
         'width': new_res[0]
     }
@@ -1123,7 +1504,7 @@ def process_camera(camera, ext, images, n_threads=1):
     if ext not in RAW_FORMATS:
         for resize_res in camera.resolutions[1:]:
             new_res = resize_res
-            create_small_json(new_res[camera.orientation in ("90", "270")], camera, fullres, new_res, p_start, p_end,
+            create_small_json(new_res[portrait], camera, fullres, new_res, p_start, p_end,
                               ts_end_text, ext, webrootaddr, thumb_image, step)
     if ext != 'raw' and camera.large_json:
         return {k: v for k, v in jdump.items()}
@@ -1131,53 +1512,62 @@ def process_camera(camera, ext, images, n_threads=1):
         return False
 
 
-def main(configfile, n_threads=1, logdir=None, debug=False):
+def main(configfile, n_threads=1, logdir=None, debug=False, io_bound=False):
     """The main loop of the module, do the renaming in parallel etc."""
     setup_logs(logdir, debug)
     start_time = time()
     n_images = 0
     json_dump = []
-    for camera in parse_camera_config_csv(configfile):
-        if (len(json_dump) == 0) and camera.large_json:
-            try:
-                already_json = open(os.path.join(camera.destination, 'all_cameras.json'), 'r')
-                json_dump = json.load(already_json)
-                already_json.close
-            except IOError:
-                pass
-        print("Processing experiment {}, location {}".format(
-            camera.expt, camera.location))
-        log.info("Processing experiment {}, location {}".format(
-            camera.expt, camera.location))
-        print("Images are coming from {}, being put in {}".format(
-            camera.source, camera.destination))
-        log.info("Images are coming from {}, being put in {}".format(
-            camera.source, camera.destination))
-        for ext, images in find_image_files(camera).items():
-            print(("Have Found {0} {1} images from this camera".format(
-                len(images), ext)))
-            log.info("Have Found {0} {1} images from this camera".format(
-                len(images), ext))
-            n_images += len(images)
-            j_dump = process_camera(camera, ext, sorted(images),
-                                    n_threads)
-            # if (camera.large_json):
-            if (j_dump):
-                json_dump.append(j_dump)
-            jpath = os.path.join(camera.destination)  # , os.path.dirname(
-            # camera.ts_structure.format(folder='', res='', cam=''))
-            try:
-                os.makedirs(jpath)
-            except OSError:
-                if not os.path.exists(jpath):
-                    log.warn("Could not make dir '{}', skipping images"
-                             .format(jpath))
-            if (len(json_dump) > 0):
-                with open(os.path.join(jpath, 'all_cameras.json'), 'w') as fname:
-                    json.dump(json_dump, fname)
-        # remove any empty directories in source
-        if camera.method == "archive":
-            empty = find_empty_dirs(camera.source)
+    # One pool of workers serves every camera and extension
+    pool = _start_pool(n_threads, io_bound) if n_threads != 1 else None
+    try:
+        for camera in parse_camera_config_csv(configfile):
+            if (len(json_dump) == 0) and camera.large_json:
+                try:
+                    with open(os.path.join(camera.destination, 'all_cameras.json')) as already_json:
+                        json_dump = json.load(already_json)
+                except IOError:
+                    pass
+            print("Processing experiment {}, location {}".format(
+                camera.expt, camera.location))
+            log.info("Processing experiment {}, location {}".format(
+                camera.expt, camera.location))
+            print("Images are coming from {}, being put in {}".format(
+                camera.source, camera.destination))
+            log.info("Images are coming from {}, being put in {}".format(
+                camera.source, camera.destination))
+            for ext, images in find_image_files(camera).items():
+                print(("Have Found {0} {1} images from this camera".format(
+                    len(images), ext)))
+                log.info("Have Found {0} {1} images from this camera".format(
+                    len(images), ext))
+                n_images += len(images)
+                # find_image_files' lists are ours, so sort without a copy
+                images.sort()
+                j_dump = process_camera(camera, ext, images,
+                                        n_threads, pool=pool)
+                # if (camera.large_json):
+                if (j_dump):
+                    json_dump.append(j_dump)
+                jpath = os.path.join(camera.destination)  # , os.path.dirname(
+                # camera.ts_structure.format(folder='', res='', cam=''))
+                try:
+                    os.makedirs(jpath)
+                except OSError:
+                    if not os.path.exists(jpath):
+                        log.warn("Could not make dir '{}', skipping images"
+                                 .format(jpath))
+                if (len(json_dump) > 0):
+                    with open(os.path.join(jpath, 'all_cameras.json'), 'w',
+                              buffering=1 << 20) as fname:
+                        json.dump(json_dump, fname, separators=(',', ':'))
+            # remove any empty directories in source
+            if camera.method == "archive":
+                empty = find_empty_dirs(camera.source)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     secs_taken = time() - start_time
     print("\nProcessed a total of {0} images in {1:.2f} seconds".format(
         n_images, secs_taken))
@@ -1202,4 +1592,5 @@ if __name__ == "__main__":
     if opts.generate:
         gen_config(opts.generate)
         sys.exit(0)
-    main(opts.config, debug=opts.debug, logdir=opts.logdir, n_threads=opts.threads)
+    main(opts.config, debug=opts.debug, logdir=opts.logdir, n_threads=opts.threads,
+         io_bound=opts.io_bound)
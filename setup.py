@@ -16,11 +16,13 @@ install_requires = [
     "docopt==0.6.1",
     "voluptuous==0.8.4",
     "pexif==0.15",
-    "Pillow==3.0.0"
+    "Pillow==3.0.0",
+    "scandir==1.10.0",
 ]
 
 test_requires = [
     "coverage==3.7.1",
+    "mock==3.0.5",
     "nose==1.3.7",
     "pep8==1.4.6",
     "pylint==1.0.0",
@@ -3,13 +3,19 @@
 
 # Standard library imports
 import copy
+import errno
 import hashlib
 import os
 from os import path
 import shutil
+import struct
 import tempfile
 import time
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 import datetime
 import warnings
 import json
@@ -24,6 +30,11 @@ try:
     from PIL import Image
 except ImportError:
     PIL = False
+try:
+    import numpy as np
+    from .. import TimestreamAudit as ta
+except ImportError:
+    ta = None
 
 
 class TestExifTraitcapture(unittest.TestCase):
@@ -321,6 +332,66 @@ class TestExifTraitcapture(unittest.TestCase):
         wontexist = fn + "_shouldnteverexist"
         self.assertEqual(e2t._dont_clobber(wontexist), wontexist)
 
+    # tests for ensure_dir
+    def test_ensure_dir_remade(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dirname = path.join(tmpdir, "a", "b")
+        e2t.ensure_dir(dirname)
+        e2t.ensure_dir(dirname)
+        self.assertTrue(path.isdir(dirname))
+        # A directory removed since must be made again
+        shutil.rmtree(path.join(tmpdir, "a"))
+        e2t.ensure_dir(dirname)
+        self.assertTrue(path.isdir(dirname))
+        # A file in the way is still an error
+        os.rmdir(dirname)
+        open(dirname, "w").close()
+        with self.assertRaises(OSError):
+            e2t.ensure_dir(dirname)
+
+    # tests for copy_file and move_file
+    def _copy_src(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        src = path.join(tmpdir, "src.jpg")
+        shutil.copyfile(self.jpg_testfile, src)
+        return src, path.join(tmpdir, "dst.jpg")
+
+    def test_copy_file_short_copy(self):
+        src, dst = self._copy_src()
+        # a kernel copy that stops short falls back to copying in python
+        with mock.patch.object(e2t, "fcntl", None), \
+                mock.patch.object(e2t.os, "copy_file_range", create=True, return_value=0):
+            e2t.copy_file(src, dst)
+        with open(self.jpg_testfile, "rb") as fh:
+            self._md5test(dst, hashlib.md5(fh.read()).hexdigest())
+
+    def test_move_file_cross_device(self):
+        src, dst = self._copy_src()
+        with open(src, "rb") as fh:
+            expt_hash = hashlib.md5(fh.read()).hexdigest()
+        exdev = OSError(errno.EXDEV, "Invalid cross-device link")
+        with mock.patch.object(e2t.os, "rename", side_effect=exdev):
+            e2t.move_file(src, dst)
+        self.assertFalse(path.exists(src))
+        self._md5test(dst, expt_hash)
+
+    def test_move_file_cross_device_incomplete(self):
+        src, dst = self._copy_src()
+        exdev = OSError(errno.EXDEV, "Invalid cross-device link")
+
+        def truncated_copy(src, dst):
+            with open(dst, "wb") as fh:
+                fh.write(b"\xff\xd8")
+        with mock.patch.object(e2t.os, "rename", side_effect=exdev), \
+                mock.patch.object(e2t, "copy_file", truncated_copy):
+            with self.assertRaises(IOError):
+                e2t.move_file(src, dst)
+        # the source is kept when the copy is incomplete, and the copy dropped
+        self.assertTrue(path.exists(src))
+        self.assertFalse(path.exists(dst))
+
     # tests for get_file_date
     def test_get_file_date_jpg(self):
         actual = time.strptime("20131112 205309", "%Y%m%d %H%M%S")
@@ -336,6 +407,53 @@ class TestExifTraitcapture(unittest.TestCase):
         date = e2t.get_file_date(self.noexif_testfile, 0)
         self.assertIsNone(date)
 
+    def test_get_file_date_cache_bounded(self):
+        actual = time.strptime("20131112 205309", "%Y%m%d %H%M%S")
+        e2t._file_dates.clear()
+        with mock.patch.object(e2t, "FILE_DATES_MAX", 1):
+            self.assertEqual(e2t.get_file_date(self.jpg_testfile, 0), actual)
+            self.assertIsNone(e2t.get_file_date(self.noexif_testfile, 0))
+            self.assertEqual(len(e2t._file_dates), 1)
+        e2t._file_dates.clear()
+
+    # tests for read_exif_date
+    def _exif_jpeg(self, date=b"2015:01:02 03:04:05\x00", order=">"):
+        """Write a minimal jpeg whose EXIF holds only DateTimeOriginal."""
+        tiff = (b"MM" if order == ">" else b"II") + struct.pack(order + "HL", 42, 8)
+        # IFD0 points to the EXIF IFD at 26, whose one tag's value is at 44
+        tiff += struct.pack(order + "HHHLLL", 1, 0x8769, 4, 1, 26, 0)
+        tiff += struct.pack(order + "HHHLLL", 1, 0x9003, 2, len(date), 44, 0)
+        segment = b"Exif\x00\x00" + tiff + date
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = path.join(tmpdir, "exif.jpg")
+        with open(filename, "wb") as fh:
+            fh.write(b"\xff\xd8\xff\xe1" + struct.pack(">H", len(segment) + 2) +
+                     segment + b"\xff\xda\x00\x02\xff\xd9")
+        return filename
+
+    def test_read_exif_date(self):
+        self.assertEqual(e2t.read_exif_date(self.jpg_testfile), "2013:11:12 20:53:09")
+        self.assertIsNone(e2t.read_exif_date(self.noexif_testfile))
+        # not a jpeg at all
+        self.assertIsNone(e2t.read_exif_date(self.raw_testfile))
+
+    def test_read_exif_date_byte_order(self):
+        for order in (">", "<"):
+            self.assertEqual(e2t.read_exif_date(self._exif_jpeg(order=order)),
+                             "2015:01:02 03:04:05")
+
+    def test_read_exif_date_truncated(self):
+        filename = self._exif_jpeg()
+        with open(filename, "rb") as fh:
+            data = fh.read()
+        with open(filename, "wb") as fh:
+            fh.write(data[:30])
+        with self.assertRaises(struct.error):
+            e2t.read_exif_date(filename)
+        # get_file_date leaves a truncated file to the other readers
+        self.assertIsNone(e2t.get_file_date(filename, 0))
+
     # tests for get_new_file_name
     def test_get_new_file_name(self):
         date = time.strptime("20131112 205309", "%Y%m%d %H%M%S")
@@ -393,6 +511,38 @@ class TestExifTraitcapture(unittest.TestCase):
         self.assertSetEqual(set(got["jpg"]), expt["jpg"])
         self.assertSetEqual(set(got["jpg"]), expt["jpg"])
 
+    # tests for _scandir_walk
+    def _walk_tree(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for sub in ("a", "b"):
+            os.makedirs(path.join(tmpdir, sub))
+            with open(path.join(tmpdir, sub, sub + ".jpg"), "w") as fh:
+                fh.write(sub)
+        return tmpdir
+
+    def test_scandir_walk_symlinked_dir(self):
+        tmpdir = self._walk_tree()
+        os.symlink(path.join(tmpdir, "a"), path.join(tmpdir, "link"))
+        # like os.walk, a symlinked dir is neither followed nor a file
+        for module in (e2t, lbt, dbt):
+            got = sorted(entry.path for entry in module._scandir_walk(tmpdir))
+            self.assertListEqual(got, [path.join(tmpdir, "a", "a.jpg"),
+                                       path.join(tmpdir, "b", "b.jpg")])
+
+    def test_scandir_walk_unreadable_dir(self):
+        tmpdir = self._walk_tree()
+        unreadable = path.join(tmpdir, "b")
+        scandir = e2t.scandir
+
+        def no_b(dirname):
+            if dirname == unreadable:
+                raise OSError(errno.EACCES, "Permission denied", dirname)
+            return scandir(dirname)
+        with mock.patch.object(e2t, "scandir", no_b):
+            got = [entry.path for entry in e2t._scandir_walk(tmpdir)]
+        self.assertListEqual(got, [path.join(tmpdir, "a", "a.jpg")])
+
     # tests for timestreamise_image
     def test_timestreamise_image(self):
         try:
@@ -414,6 +564,13 @@ class TestExifTraitcapture(unittest.TestCase):
         self.assertTrue(path.exists(self.r_fullres_path))
         self._md5test(self.r_fullres_path, "b0895204732d2806780e87ea6ce8e874")
 
+    def test_process_image_skipped_keeps_source(self):
+        camera = copy.deepcopy(self.camera)
+        camera.method = "move"
+        with mock.patch.object(e2t, "timestreamise_image", side_effect=e2t.SkipImage):
+            e2t.process_image((self.jpg_testfile, camera, "jpg", False))
+        self.assertTrue(path.exists(self.jpg_testfile))
+
     # tests for parse_camera_config_csv
     def test_parse_camera_config_csv(self):
         configs = [
@@ -502,6 +659,34 @@ class TestExifTraitcapture(unittest.TestCase):
             pass
         self.assertEqual(w, new_width)
 
+    def test_resize_img_copies_exif(self):
+        if not PIL:
+            ("PIL not available, can't test resizing", ImportWarning)
+            return
+
+        formats = []
+
+        class Resized(object):
+            # stands in for the resized image, as a jpeg with no exif
+            def save(self, fh, format=None):
+                formats.append(format)
+                with open(TestExifTraitcapture.noexif_testfile, "rb") as src:
+                    fh.write(src.read())
+
+        class Original(object):
+            def resize(self, size):
+                return Resized()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dest = path.join(tmpdir, "resized.jpg")
+        e2t.resize_img(self.jpg_testfile, dest, 400, 300, Original())
+        self.assertListEqual(formats, ["JPEG"])
+        source = e2t.pexif.JpegFile.fromFile(self.jpg_testfile).exif.primary
+        resized = e2t.pexif.JpegFile.fromFile(dest).exif.primary
+        self.assertEqual(resized.ExtendedEXIF.DateTimeOriginal,
+                         source.ExtendedEXIF.DateTimeOriginal)
+        self.assertEqual(resized.Orientation, source.Orientation)
+
     def test_main(self):
         e2t.main(self.test_config_csv, logdir=self.out_dirname)
         self.assertTrue(path.exists(self.r_fullres_path))
@@ -1080,7 +1265,7 @@ class TestExifTraitcapture(unittest.TestCase):
         list_time = lbt.CameraFields(list_time)
         for ext, images in lbt.find_image_files(list_time).items():
             lbt.process_timestream(list_time, ext, sorted(images), 1)
-        with open(os.path.join(list_time.delete_dest, list_time.timestream_name + '_Night_Files.csv'), 'rb') as f:
+        with open(os.path.join(list_time.delete_dest, list_time.timestream_name + '_Night_Files.csv')) as f:
             reader = csv.reader(f)
             output_list = sorted(list(reader)[1:])
         timestream_list = sorted([
@@ -1096,6 +1281,20 @@ class TestExifTraitcapture(unittest.TestCase):
         ])
         self.assertEqual(output_list, timestream_list)
 
+    def test_ListByTime_threads(self):
+        # each worker's listed images come back, so the file is the same
+        # however many processes list them
+        list_time = lbt.CameraFields(copy.deepcopy(self.config_list_delete))
+        csv_file = os.path.join(list_time.delete_dest, list_time.timestream_name + '_Night_Files.csv')
+        listed = []
+        for n_threads in (1, 2):
+            for ext, images in lbt.find_image_files(list_time).items():
+                lbt.process_timestream(list_time, ext, sorted(images), n_threads)
+            with open(csv_file) as f:
+                listed.append(list(csv.reader(f))[1:])
+        self.assertEqual(len(listed[0]), 9)
+        self.assertListEqual(listed[1], listed[0])
+
     def test_DelByTime(self):
         self.wipe_output()
         del_time = copy.deepcopy(self.config_list_delete)
@@ -1165,6 +1364,79 @@ class TestExifTraitcapture(unittest.TestCase):
         self.assertListEqual(sorted(no_subfolder['jpg']), no_sub_expt['jpg'])
 
 
+
+@unittest.skipIf(ta is None, "numpy or matplotlib not available")
+class TestTimestreamAudit(unittest.TestCase):
+    days = [datetime.date(2015, 3, 1), datetime.date(2015, 3, 2)]
+
+    def _series(self, days, start, end, minutes):
+        """Images every minutes from start to end on each of days."""
+        images = []
+        for day in days:
+            image = datetime.datetime.combine(day, start)
+            while image.time() <= end and image.date() == day:
+                images.append(image)
+                image += datetime.timedelta(minutes=minutes)
+        return images
+
+    def _audit(self, images):
+        """The interval, start and end times, and missing images, as audited."""
+        date_times = np.array(sorted(images), dtype='datetime64[s]')
+        interval = ta.get_interval(date_times)
+        start_time, end_time = ta.get_start_end(date_times)
+        missing = ta.find_missing_images(date_times, self.days[0], self.days[-1],
+                                         start_time, end_time, interval)
+        return interval, (start_time, end_time), missing.tolist()
+
+    def test_regular(self):
+        images = self._series(self.days, datetime.time(8), datetime.time(10), 5)
+        interval, start_end, missing = self._audit(images)
+        self.assertEqual(interval, 300)
+        self.assertEqual(start_end, (datetime.time(8), datetime.time(10)))
+        self.assertListEqual(missing, [])
+
+    def test_gaps(self):
+        gaps = [datetime.datetime(2015, 3, 1, 8, 30),
+                datetime.datetime(2015, 3, 1, 9, 15),
+                datetime.datetime(2015, 3, 2, 9, 0)]
+        images = [image for image in
+                  self._series(self.days, datetime.time(8), datetime.time(10), 5)
+                  if image not in gaps]
+        interval, start_end, missing = self._audit(images)
+        self.assertEqual(interval, 300)
+        self.assertEqual(start_end, (datetime.time(8), datetime.time(10)))
+        self.assertListEqual(missing, gaps)
+
+    def test_odd_interval(self):
+        # No 7 minute interval, so each day counts as hourly, then rounds up
+        images = self._series(self.days, datetime.time(8), datetime.time(10), 7)
+        interval, start_end, missing = self._audit(images)
+        self.assertEqual(interval, 61 * 60)
+        self.assertEqual(start_end, (datetime.time(8), datetime.time(9, 59)))
+        self.assertListEqual(missing, [datetime.datetime(2015, 3, 1, 9, 1),
+                                       datetime.datetime(2015, 3, 2, 9, 1)])
+
+    def test_mixed_intervals(self):
+        # The mean of the days' 5 and 10 minute intervals
+        images = (self._series(self.days[:1], datetime.time(8), datetime.time(10), 5) +
+                  self._series(self.days[1:], datetime.time(8), datetime.time(10), 10))
+        interval, start_end, missing = self._audit(images)
+        self.assertEqual(interval, 7 * 60)
+        self.assertEqual(len(missing), 30)
+        self.assertEqual(missing[0], datetime.datetime(2015, 3, 1, 8, 7))
+
+    def test_duplicates(self):
+        # The second day stops early, and an image is stored twice
+        images = (self._series(self.days[:1], datetime.time(8), datetime.time(10), 5) +
+                  self._series(self.days[1:], datetime.time(8), datetime.time(9), 5))
+        images.append(datetime.datetime(2015, 3, 1, 8, 30))
+        interval, start_end, missing = self._audit(images)
+        self.assertEqual(interval, 300)
+        self.assertEqual(start_end, (datetime.time(8), datetime.time(10)))
+        # Times after the last image aren't missing, duplicates or not
+        self.assertListEqual(missing, [])
+
+
 if __name__ == "__main__":
     runner = unittest.TextTestRunner(verbosity=3)
     unittest.main(testRunner=runner)